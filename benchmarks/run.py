@@ -0,0 +1,212 @@
+'''Benchmark each stage of pixelart on synthetic data.
+
+Run from the repository root, for example:
+
+    python benchmarks/run.py --textures 50,400 --sizes 64,512 \
+            --output results.json
+
+and compare two runs, failing if any stage got more than 10% slower:
+
+    python benchmarks/run.py --compare old.json results.json \
+            --threshold 0.1
+'''
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+import numpy as np
+import PIL
+
+from pixelart.engine import PixelartEngine, find_ckdtree
+from pixelart.options import PERCEPTUAL_COLORSPACES
+from synthetic import make_texture_dir, make_texture_pack, make_image
+
+# Fields which identify a result, so runs can be compared.
+KEY_FIELDS = ['pack', 'textures', 'image', 'matcher', 'colorspace',
+              'stage']
+
+
+def best_time(function, repeat):
+    '''Run function repeat times and return the fastest time
+    in seconds, along with the last result.'''
+
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def run(args):
+
+    results = []
+    def record(seconds, **key):
+        key['seconds'] = seconds
+        results.append(key)
+        print('%-6s %5d textures %5dpx %-6s %-5s %-14s %9.4fs' %
+              tuple(key[field] for field in KEY_FIELDS + ['seconds']))
+
+    matchers = args.matchers
+    if 'kdtree' in matchers and not find_ckdtree():
+        print('scipy is not installed, skipping kdtree')
+        matchers = [m for m in matchers if m != 'kdtree']
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for count in args.textures:
+            packs = dict(
+                dir=make_texture_dir(os.path.join(tmp, 'dir%d' % count),
+                                     count),
+                jar=make_texture_pack(os.path.join(tmp, '%d.jar' % count),
+                                      count))
+            for colorspace in args.colorspaces:
+                # Lookup tables would just fall back to brute force
+                colorspace_matchers = matchers
+                if colorspace in PERCEPTUAL_COLORSPACES:
+                    colorspace_matchers = [m for m in matchers
+                                           if m != 'lut']
+                for pack, path in sorted(packs.items()):
+                    engine = PixelartEngine(path, colorspace=colorspace)
+                    seconds, _ = best_time(engine.load_textures,
+                                           args.repeat)
+                    record(seconds, pack=pack, textures=count, image=0,
+                           matcher='-', colorspace=colorspace,
+                           stage='load_textures')
+
+                # Everything else doesn't care where the textures
+                # came from, so use the last engine.
+                if 'lut' in colorspace_matchers:
+                    # The table is built once and then reused, so
+                    # time building it on its own.
+                    engine.matcher = 'lut'
+                    tiny = np.zeros((1, 1, 3), dtype='uint8')
+                    seconds, _ = best_time(lambda: engine.match(tiny), 1)
+                    record(seconds, pack='-', textures=count, image=0,
+                           matcher='lut', colorspace=colorspace,
+                           stage='build_lut')
+
+                for size in args.sizes:
+                    image = make_image(size).convert(engine.image_mode)
+                    pixels = np.asarray(image)
+                    for matcher in colorspace_matchers:
+                        engine.matcher = matcher
+                        seconds, neighbors = best_time(
+                                lambda: engine.match(pixels), args.repeat)
+                        record(seconds, pack='-', textures=count,
+                               image=size, matcher=matcher,
+                               colorspace=colorspace, stage='match')
+
+                    seconds, _ = best_time(lambda: engine.render(neighbors),
+                                           args.repeat)
+                    record(seconds, pack='-', textures=count, image=size,
+                           matcher='-', colorspace=colorspace,
+                           stage='render')
+                    seconds, _ = best_time(lambda: engine.report(neighbors),
+                                           args.repeat)
+                    record(seconds, pack='-', textures=count, image=size,
+                           matcher='-', colorspace=colorspace,
+                           stage='report')
+
+    return dict(meta=dict(python=platform.python_version(),
+                          numpy=np.__version__, pillow=PIL.__version__,
+                          platform=platform.platform(),
+                          machine=platform.machine(),
+                          cpus=os.cpu_count()),
+                results=results)
+
+
+def compare(old_path, new_path, threshold):
+    '''Compare two result files. Returns True if nothing got slower
+    by more than threshold (a fraction).'''
+
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+
+    def by_key(data):
+        return {tuple(r[field] for field in KEY_FIELDS): r['seconds']
+                for r in data['results']}
+    old = by_key(old)
+    new = by_key(new)
+
+    ok = True
+    for key in sorted(set(old) & set(new), key=str):
+        ratio = new[key] / old[key] if old[key] > 0 else 1.0
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '  SLOWER'
+            ok = False
+        elif ratio < 1 - threshold:
+            flag = '  faster'
+        print('%-6s %5d textures %5dpx %-6s %-5s %-14s' % key +
+              ' %9.4fs -> %9.4fs (%5.2fx)%s' %
+              (old[key], new[key], ratio, flag))
+    for key in sorted(set(old) ^ set(new), key=str):
+        print('only in %s: %r' % ('old' if key in old else 'new', key))
+    return ok
+
+
+def int_list(string):
+    return [int(s) for s in string.split(',')]
+
+
+def str_list(string):
+    return string.split(',')
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Benchmark pixelart '
+                                     'on synthetic textures and images')
+    parser.add_argument('--textures', type=int_list, default=[50, 400],
+                        help='Comma separated texture pack sizes.\
+                                (default: 50,400)')
+    parser.add_argument('--sizes', type=int_list, default=[64, 256],
+                        help='Comma separated input image sizes, in\
+                                pixels per side. (default: 64,256)')
+    parser.add_argument('--matchers', type=str_list,
+                        default=['kdtree', 'brute', 'lut'],
+                        help='Comma separated matchers to time.\
+                                (default: kdtree,brute,lut)')
+    parser.add_argument('--colorspaces', type=str_list, default=['RGB'],
+                        help='Comma separated colorspaces to time.\
+                                (default: RGB)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Times to run each stage; the fastest\
+                                counts. (default: %(default)s)')
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help='Path to write JSON results to.')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='Compare two JSON results instead of\
+                                running benchmarks.')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='With --compare, fail if a stage is this\
+                                much slower (as a fraction).\
+                                (default: %(default)s)')
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        if not compare(args.compare[0], args.compare[1], args.threshold):
+            sys.exit(1)
+        return
+
+    results = run(args)
+    if args.output is not None:
+        with open(args.output, mode='w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+
+
+if __name__ == '__main__':
+    main()
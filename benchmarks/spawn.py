@@ -0,0 +1,82 @@
+'''Check that batch conversion works when worker processes are
+spawned instead of forked, as on Windows and macOS.
+
+Spawned workers get a pickled copy of the engine, so this fails if
+anything the engine keeps (like a lock) can't be pickled, or if the
+outputs differ from converting in one process. Run from the
+repository root:
+
+    python benchmarks/spawn.py
+'''
+
+import argparse
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+import numpy as np
+from PIL import Image
+
+from pixelart.engine import PixelartEngine
+from pixelart.batch import BatchProcessor
+from synthetic import make_texture_dir, make_image
+
+
+def convert_all(engine, jobs, workers, start_method):
+    batch = BatchProcessor(engine, jobs, workers=workers,
+                           start_method=start_method)
+    return batch.process()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Check batch conversion '
+                                     'with spawned workers')
+    parser.add_argument('--images', type=int, default=4,
+                        help='Images to convert. (default: %(default)s)')
+    parser.add_argument('--jobs', type=int, default=2,
+                        help='Worker processes. (default: %(default)s)')
+    args = parser.parse_args()
+
+    ok = True
+    with tempfile.TemporaryDirectory() as tmp:
+        textures = make_texture_dir(os.path.join(tmp, 'textures'), 50)
+        engine = PixelartEngine(textures)
+        if not engine.load_textures():
+            sys.exit("Couldn't load textures!")
+
+        inputs = []
+        for i in range(args.images):
+            path = os.path.join(tmp, 'in%d.png' % i)
+            make_image(32, seed=i).save(path)
+            inputs.append(path)
+
+        outputs = {}
+        for name, workers, start_method in [('single', 1, None),
+                                            ('spawn', args.jobs, 'spawn')]:
+            jobs = [(path, os.path.join(tmp, name, os.path.basename(path)))
+                    for path in inputs]
+            failures = convert_all(engine, jobs, workers, start_method)
+            status = 'ok'
+            if failures is None or failures:
+                status = 'FAILED %s' % (failures,)
+                ok = False
+            print('%-8s %s' % (name, status))
+            outputs[name] = [np.asarray(Image.open(out))
+                             for _, out in jobs if os.path.isfile(out)]
+
+        if len(outputs['spawn']) != len(outputs['single']) or \
+                any(not np.array_equal(a, b) for a, b in
+                    zip(outputs['single'], outputs['spawn'])):
+            print('spawned workers made different outputs!')
+            ok = False
+
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
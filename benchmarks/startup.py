@@ -0,0 +1,84 @@
+'''Check that importing the command line stays quick.
+
+Runs ``python -X importtime`` on each entry point module and fails
+if it takes longer than a threshold, or if it imports a module that
+should only be loaded on first use (numpy, PIL, scipy, tkinter).
+Run from the repository root:
+
+    python benchmarks/startup.py --threshold 100
+'''
+
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules each entry point should import, and modules they must not
+# import until they are actually needed.
+CHECKS = [
+    ('pixelart', ['numpy', 'PIL', 'scipy', 'tkinter']),
+    ('pixelart.cli', ['numpy', 'PIL', 'scipy', 'tkinter']),
+]
+
+
+def import_times(module):
+    '''Import module in a fresh interpreter. Returns a dict of
+    module name -> cumulative import time in microseconds.'''
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+            [ROOT] + [p for p in [env.get('PYTHONPATH')] if p])
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                             'import %s' % module],
+                            env=env, stderr=subprocess.PIPE,
+                            universal_newlines=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line.split('|')
+        try:
+            times[name.strip()] = int(cumulative)
+        except ValueError:
+            # The header line
+            continue
+    return times
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Check pixelart import '
+                                     'times')
+    parser.add_argument('--threshold', type=float, default=100,
+                        help='Fail if an entry point takes longer than\
+                                this many milliseconds to import.\
+                                (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Imports to try; the fastest counts.\
+                                (default: %(default)s)')
+    args = parser.parse_args()
+
+    ok = True
+    for module, forbidden in CHECKS:
+        runs = [import_times(module) for i in range(args.repeat)]
+        best = min(run[module] for run in runs) / 1000
+        status = 'ok'
+        if best > args.threshold:
+            status = 'TOO SLOW'
+            ok = False
+        print('%-16s %8.1fms %s' % (module, best, status))
+
+        roots = sorted(set(name.split('.')[0] for name in runs[0]
+                           if name.split('.')[0] in forbidden))
+        if roots:
+            print('    imports %s eagerly!' % ', '.join(roots))
+            ok = False
+
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
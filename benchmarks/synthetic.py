@@ -0,0 +1,59 @@
+'''Synthetic textures and images for benchmarking, so benchmarks
+can run without any real Minecraft assets.'''
+
+from PIL import Image
+import numpy as np
+import io
+import os
+import zipfile
+
+# Where textures go inside a synthetic jar. This must be one of
+# the directories the engine searches.
+PACK_TEXTURE_DIR = 'assets/minecraft/textures/blocks'
+
+
+def texture_images(count, size=(16,16), seed=0):
+    '''Make count noisy textures, each with its own base color.
+    Yields (name, PIL image). Names are chosen so that the default
+    NameFilter lets them all through.'''
+
+    rng = np.random.default_rng(seed)
+    w, h = size
+    for i in range(count):
+        base = rng.integers(0, 256, 3)
+        noise = rng.integers(-24, 25, (h, w, 3))
+        pixels = np.clip(base + noise, 0, 255).astype('uint8')
+        yield 'bench_%04d' % i, Image.fromarray(pixels)
+
+
+def make_texture_dir(path, count, size=(16,16), seed=0):
+    '''Write count textures as PNGs into the directory path.'''
+
+    os.makedirs(path, exist_ok=True)
+    for name, texture in texture_images(count, size, seed):
+        texture.save(os.path.join(path, name + '.png'))
+    return path
+
+
+def make_texture_pack(path, count, size=(16,16), seed=0):
+    '''Write count textures into a zip (jar) file at path, laid out
+    like a Minecraft jar.'''
+
+    with zipfile.ZipFile(path, 'w') as pack:
+        for name, texture in texture_images(count, size, seed):
+            data = io.BytesIO()
+            texture.save(data, format='PNG')
+            pack.writestr('%s/%s.png' % (PACK_TEXTURE_DIR, name),
+                          data.getvalue())
+    return path
+
+
+def make_image(size, seed=0):
+    '''Make a square RGB test image of size x size pixels, with smooth
+    gradients (like a photo) overlaid with some noise.'''
+
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size, 0:size] / max(1, size - 1)
+    pixels = np.stack([x, y, 1 - (x + y) / 2], axis=2) * 255
+    pixels += rng.normal(0, 12, pixels.shape)
+    return Image.fromarray(np.clip(pixels, 0, 255).astype('uint8'))
@@ -1,14 +1,17 @@
-
-from pixelart import gui
-from pixelart import cli
+# Each entry point imports only what it needs, so the command line
+# starts quickly and works without tkinter.
 
 def main():
     main_cli()
 
 def main_cli():
+    from pixelart import cli
     cli.main()
 
 def main_gui():
+    from pixelart import gui
     gui.main()
 
-
+def main_serve():
+    from pixelart import server
+    server.main()
@@ -0,0 +1,223 @@
+from PIL import Image, ImageSequence
+import numpy as np
+import logging
+import os
+
+from pixelart.render import render_rows, render_cells
+from pixelart.report import write_frame_reports
+from pixelart.metrics import RunMetrics
+
+# How long (in milliseconds) to show frames which don't say
+DEFAULT_FRAME_DURATION = 100
+
+# Outputs with these extensions are saved as one animated image
+# (.png as an APNG). Anything else is a directory of frames.
+ANIMATED_FORMATS = ['.gif', '.png', '.apng', '.webp']
+
+
+def read_frames(path):
+    '''Yield (frame, duration) for every frame of an animated image, or
+    for every image in a directory in name order. Frames are RGB PIL
+    images and durations are in milliseconds.'''
+
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            frame_path = os.path.join(path, name)
+            if name.startswith('.') or not os.path.isfile(frame_path):
+                continue
+            with Image.open(frame_path) as image:
+                yield image.convert('RGB'), \
+                        image.info.get('duration', DEFAULT_FRAME_DURATION)
+        return
+
+    with Image.open(path) as image:
+        for frame in ImageSequence.Iterator(image):
+            yield frame.convert('RGB'), \
+                    frame.info.get('duration', DEFAULT_FRAME_DURATION)
+
+
+def animation_loop(path):
+    '''Get how many times an animation loops (0 is forever).'''
+
+    if os.path.isdir(path):
+        return 0
+    with Image.open(path) as image:
+        return image.info.get('loop', 0)
+
+
+class RenderedFrames:
+    '''Frames of an animation as PIL images, rendered from their block
+    grids as they are iterated over, so only one is in memory at once.
+    Each frame only renders the blocks which changed since the last.
+
+    PIL goes over append_images more than once for some formats, which
+    a generator wouldn't allow, so every iteration starts again.
+    '''
+
+    def __init__(self, atlas, grids):
+        self.atlas = atlas
+        self.grids = grids
+
+    def __len__(self):
+        return len(self.grids)
+
+    def __iter__(self):
+        output = None
+        previous = None
+        for grid in self.grids:
+            if output is None:
+                output = render_rows(self.atlas, grid)
+            else:
+                rows, cols = np.nonzero(grid != previous)
+                render_cells(self.atlas, grid, output, rows, cols)
+            previous = grid
+            # fromarray may share memory with output, which the next
+            # frame changes.
+            yield Image.fromarray(output).copy()
+
+
+class AnimationProcessor:
+    '''Converts every frame of an animation with one PixelartEngine.
+
+    Frames usually differ from the one before in only a few pixels, so
+    only those are matched again, and only blocks whose texture changed
+    are rendered again. The rest is kept from the frame before.
+    '''
+
+    def __init__(self, engine, input_path, output_path, image_scaling=None,
+                 report_path=None, metrics=None, logger=None):
+
+        self.engine = engine
+        self.input_path = input_path
+        self.output_path = output_path
+        self.image_scaling = image_scaling
+        self.report_path = report_path
+
+        self.metrics = metrics
+        if self.metrics is None:
+            self.metrics = RunMetrics()
+
+        self.logger = logger
+        if self.logger is None:
+            self.logger = logging.getLogger(__name__)
+
+        self.reset()
+
+    def reset(self):
+        '''Forget the last frame, so the next one is done from scratch.'''
+
+        self.pixels = None
+        self.neighbors = None
+        self.output = None
+
+    def animated_output(self):
+        ext = os.path.splitext(self.output_path)[1].lower()
+        return ext in ANIMATED_FORMATS
+
+    def convert_frame(self, frame):
+        '''Match and render one frame, starting from the last one.
+        Returns the number of pixels matched, or None if cancelled.'''
+
+        engine = self.engine
+        if self.image_scaling is not None:
+            frame = engine.scale_image(frame, self.image_scaling)
+        elif frame.mode != engine.image_mode:
+            frame = frame.convert(engine.image_mode)
+        pixels = np.asarray(frame)
+
+        if self.pixels is None or self.pixels.shape != pixels.shape:
+            self.neighbors = engine.match(pixels)
+            if self.neighbors is None:
+                self.reset()
+                return None
+            self.output = render_rows(engine.atlas, self.neighbors)
+            self.pixels = pixels
+            return pixels.shape[0] * pixels.shape[1]
+
+        rows, cols = np.nonzero((pixels != self.pixels).any(axis=2))
+        changed = len(rows)
+        if changed > 0:
+            # Match the changed pixels as one column, which the engine
+            # can split into tiles like any other image.
+            found = engine.match(pixels[rows, cols][:, np.newaxis])
+            if found is None:
+                return None
+            found = found[:, 0]
+            moved = found != self.neighbors[rows, cols]
+            rows = rows[moved]
+            cols = cols[moved]
+            self.neighbors[rows, cols] = found[moved]
+            render_cells(engine.atlas, self.neighbors, self.output,
+                         rows, cols)
+        self.pixels = pixels
+        return changed
+
+    def process(self):
+        '''Convert every frame. Returns False if something went wrong.'''
+
+        metrics = self.metrics
+        engine = self.engine
+
+        if engine.names is None:
+            with metrics.stage('load_textures'):
+                if not engine.load_textures():
+                    return False
+        metrics.set_count('textures_loaded', len(engine.names))
+
+        animated = self.animated_output()
+        if not animated:
+            os.makedirs(self.output_path, exist_ok=True)
+
+        self.reset()
+        # Animated outputs are saved at the end, so keep each frame's
+        # block grid (one value per block) rather than its image.
+        grids = []
+        durations = []
+        reports = []
+        try:
+            with metrics.stage('frames'):
+                for number, (frame, duration) in \
+                        enumerate(read_frames(self.input_path)):
+                    matched = self.convert_frame(frame)
+                    if matched is None:
+                        return False
+                    self.logger.info("Frame %d: matched %d of %d pixels" %
+                                     (number, matched, self.neighbors.size))
+                    metrics.count('frames')
+                    metrics.count('pixels_matched', matched)
+                    reports.append(engine.report(self.neighbors))
+
+                    if animated:
+                        grids.append(self.neighbors.copy())
+                        durations.append(duration)
+                    else:
+                        path = os.path.join(self.output_path,
+                                            'frame_%04d.png' % number)
+                        Image.fromarray(self.output).save(path)
+                        metrics.count('output_bytes',
+                                      os.path.getsize(path))
+        except (OSError, ValueError) as e:
+            self.logger.critical("Couldn't read frames! (%s)" % e)
+            return False
+
+        if not reports:
+            self.logger.critical("No frames found in %s!" % self.input_path)
+            return False
+
+        if animated:
+            with metrics.stage('save'):
+                first = render_rows(engine.atlas, grids[0])
+                Image.fromarray(first).save(self.output_path,
+                        save_all=True,
+                        append_images=RenderedFrames(engine.atlas,
+                                                     grids[1:]),
+                        duration=durations,
+                        loop=animation_loop(self.input_path))
+            metrics.set_count('output_bytes',
+                              os.path.getsize(self.output_path))
+
+        if self.report_path is not None:
+            write_frame_reports(self.report_path, reports)
+
+        self.logger.info("Converted %d frames!" % len(reports))
+        return True
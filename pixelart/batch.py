@@ -0,0 +1,265 @@
+from PIL import Image
+import glob
+import logging
+import multiprocessing
+import os
+import traceback
+
+from pixelart.report import write_block_report
+from pixelart.metrics import RunMetrics
+
+# Files with these extensions are read as manifests of
+# input/output pairs instead of being converted.
+MANIFEST_EXTENSIONS = ['.txt', '.csv', '.tsv', '.lst']
+
+# The engine used by worker processes. With fork, children inherit
+# it from the parent along with its textures, without copying them.
+_engine = None
+
+
+def read_manifest(path, output_dir, output_ext='.png'):
+    '''Read input/output pairs from a manifest file.
+
+    Each line holds an input path, optionally followed by a tab or
+    comma and an output path. Relative output paths (and inputs
+    without one) go in output_dir. Blank lines and lines starting
+    with # are ignored.
+    '''
+
+    base = os.path.dirname(path)
+    jobs = []
+    with open(path, mode='r') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            sep = '\t' if '\t' in line else ','
+            parts = [part.strip() for part in line.split(sep, 1)]
+            in_path = os.path.join(base, parts[0])
+            if len(parts) > 1 and parts[1]:
+                out_path = os.path.join(output_dir, parts[1])
+            else:
+                out_path = output_path(in_path, output_dir, output_ext)
+            jobs.append((in_path, out_path))
+    return jobs
+
+
+def output_path(in_path, output_dir, output_ext='.png'):
+    name = os.path.splitext(os.path.basename(in_path))[0]
+    return os.path.join(output_dir, name + output_ext)
+
+
+def collect_jobs(source, output_dir, output_ext='.png'):
+    '''Get a list of (input, output) paths to convert.
+
+    source is a directory (every file in it is converted), a glob
+    pattern, a manifest file (see read_manifest) or a single image.
+    '''
+
+    if os.path.isdir(source):
+        inputs = [os.path.join(source, name)
+                  for name in sorted(os.listdir(source))]
+        inputs = [path for path in inputs if os.path.isfile(path)]
+    elif os.path.isfile(source):
+        if os.path.splitext(source)[1].lower() in MANIFEST_EXTENSIONS:
+            return read_manifest(source, output_dir, output_ext)
+        inputs = [source]
+    else:
+        inputs = sorted(glob.glob(source))
+    return [(path, output_path(path, output_dir, output_ext))
+            for path in inputs]
+
+
+def duplicate_paths(paths):
+    '''Get the paths which more than one job would write to, sorted.'''
+
+    seen = set()
+    duplicates = set()
+    for path in paths:
+        key = os.path.normcase(os.path.abspath(path))
+        if key in seen:
+            duplicates.add(path)
+        seen.add(key)
+    return sorted(duplicates)
+
+
+def convert(engine, in_path, out_path, image_scaling=None,
+            streaming=False, grid_output=False, report_path=None):
+    '''Convert one image file with an engine whose textures are
+    already loaded.'''
+
+    image = Image.open(in_path)
+    if image_scaling is not None:
+        image = engine.scale_image(image, image_scaling)
+    engine.plan_memory(image.height, image.width,
+                       render=not (grid_output or streaming))
+    neighbors = engine.match(image)
+    if neighbors is None:
+        raise ValueError("Invalid image size %dx%d" %
+                         (image.width, image.height))
+
+    if grid_output:
+        if not engine.save_grid(neighbors, out_path):
+            raise ValueError("Unknown block grid format %s" %
+                             os.path.splitext(out_path)[1])
+    elif not ((streaming or engine.out_of_core) and
+              engine.render_to_file(neighbors, out_path)):
+        if streaming or engine.out_of_core:
+            engine.logger.warning("Can't stream %s, so the whole image "
+                                  "will be made in memory." % out_path)
+        output = engine.render(neighbors)
+        if output is None:
+            raise MemoryError("Ran out of memory while creating "
+                              "final image!")
+        output.save(out_path)
+
+    if report_path is not None:
+        write_block_report(report_path, engine.report(neighbors))
+
+
+def _set_engine(engine):
+    global _engine
+    _engine = engine
+
+
+def _convert_job(args):
+    '''Run convert() in a worker, returning an error message
+    instead of raising so one bad image doesn't stop the batch.'''
+
+    in_path, out_path, options = args
+    try:
+        convert(_engine, in_path, out_path, **options)
+        return in_path, out_path, None
+    except Exception as e:
+        _engine.logger.debug(traceback.format_exc())
+        return in_path, out_path, '%s: %s' % (type(e).__name__, e)
+
+
+class BatchProcessor:
+    '''Converts many images with one PixelartEngine, optionally
+    spread over a pool of worker processes.'''
+
+    def __init__(self, engine, jobs, workers=1, image_scaling=None,
+                 streaming=False, grid_output=False, report_dir=None,
+                 start_method=None, metrics=None, logger=None):
+
+        self.engine = engine
+        self.jobs = jobs
+        self.workers = workers
+        # How worker processes are started. By default fork where we
+        # can, otherwise the engine is pickled to each worker.
+        self.start_method = start_method
+        self.image_scaling = image_scaling
+        self.streaming = streaming
+        self.grid_output = grid_output
+        self.report_dir = report_dir
+
+        self.metrics = metrics
+        if self.metrics is None:
+            self.metrics = RunMetrics()
+
+        self.logger = logger
+        if self.logger is None:
+            self.logger = logging.getLogger(__name__)
+
+    def report_path(self, out_path):
+        # Named after the output, which a manifest can make unique
+        return output_path(out_path, self.report_dir, '.txt')
+
+    def job_args(self):
+        for in_path, out_path in self.jobs:
+            options = dict(image_scaling=self.image_scaling,
+                           streaming=self.streaming,
+                           grid_output=self.grid_output)
+            if self.report_dir is not None:
+                options['report_path'] = self.report_path(out_path)
+            yield in_path, out_path, options
+
+    def results(self):
+        '''Convert every job, yielding (input, output, error) as they
+        finish. error is None if the conversion worked.'''
+
+        if self.workers <= 1:
+            _set_engine(self.engine)
+            for args in self.job_args():
+                yield _convert_job(args)
+            return
+
+        # Prefer fork so workers share the parent's textures instead
+        # of each getting a pickled copy. The matcher (and its lookup
+        # table) is made first, so they share that too.
+        start_method = self.start_method
+        if start_method is None and \
+                'fork' in multiprocessing.get_all_start_methods():
+            start_method = 'fork'
+        context = multiprocessing.get_context(start_method)
+        if start_method == 'fork':
+            self.logger.debug("Preparing the matcher before forking...")
+            self.engine.warm_up()
+            _set_engine(self.engine)
+            pool = context.Pool(self.workers)
+        else:
+            pool = context.Pool(self.workers,
+                    initializer=_set_engine, initargs=(self.engine,))
+
+        with pool:
+            for result in pool.imap_unordered(_convert_job,
+                                              self.job_args()):
+                yield result
+
+    def process(self):
+        '''Convert every job. Returns a list of (input, error) for the
+        jobs that failed.'''
+
+        if not self.jobs:
+            self.logger.critical("No input images found!")
+            return None
+
+        # Outputs are named after their inputs, so inputs with the same
+        # name (like a.png and a.jpg) would overwrite each other.
+        paths = [out_path for _, out_path in self.jobs]
+        if self.report_dir is not None:
+            paths += [self.report_path(out_path)
+                      for _, out_path in self.jobs]
+        duplicates = duplicate_paths(paths)
+        if duplicates:
+            self.logger.critical("More than one image would be written "
+                                 "to %s! Give them different output "
+                                 "paths in a manifest." %
+                                 ', '.join(duplicates))
+            return None
+        if self.engine.names is None:
+            with self.metrics.stage('load_textures'):
+                if not self.engine.load_textures():
+                    return None
+        self.metrics.set_count('textures_loaded', len(self.engine.names))
+        for path in set(os.path.dirname(out) for _, out in self.jobs):
+            os.makedirs(path or '.', exist_ok=True)
+        if self.report_dir is not None:
+            os.makedirs(self.report_dir, exist_ok=True)
+
+        self.logger.info("Converting %d images with %d workers..." %
+                         (len(self.jobs), self.workers))
+        failures = []
+        with self.metrics.stage('convert'):
+            for done, (in_path, out_path, error) in \
+                    enumerate(self.results(), start=1):
+                if error is None:
+                    self.logger.info("(%d of %d) %s -> %s" % (done,
+                            len(self.jobs), in_path, out_path))
+                    self.metrics.count('images_converted')
+                    self.metrics.count('output_bytes',
+                                       os.path.getsize(out_path))
+                else:
+                    self.logger.error("(%d of %d) Couldn't convert %s! "
+                                      "(%s)" % (done, len(self.jobs),
+                                                in_path, error))
+                    self.metrics.count('images_failed')
+                    failures.append((in_path, error))
+
+        if failures:
+            self.logger.critical("%d of %d images failed!" %
+                                 (len(failures), len(self.jobs)))
+        else:
+            self.logger.info("Converted %d images!" % len(self.jobs))
+        return failures
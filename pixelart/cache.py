@@ -0,0 +1,140 @@
+import numpy as np
+import os
+import hashlib
+import tempfile
+import shutil
+
+# Bump this whenever the layout of cache entries changes,
+# so old entries are ignored instead of misread.
+CACHE_VERSION = 1
+
+
+def fingerprint_path(path):
+    '''Hash the contents of a texture file, or the names, sizes and
+    modification times of the files in a texture directory.'''
+
+    h = hashlib.sha1()
+    if os.path.isdir(path):
+        h.update(os.path.abspath(path).encode('utf-8') + b'\0')
+        for name in sorted(os.listdir(path)):
+            st = os.stat(os.path.join(path, name))
+            h.update(('%s\0%d\0%d\0' % (name, st.st_size,
+                                         st.st_mtime_ns)).encode('utf-8'))
+    else:
+        with open(path, mode='rb') as f:
+            for block in iter(lambda: f.read(2**20), b''):
+                h.update(block)
+    return h.hexdigest()
+
+
+class PaletteCache:
+    '''On-disk cache of the textures loaded from a texture path.
+
+    Each entry is a directory named after a fingerprint of the
+    texture path, the NameFilter settings and the texture dimension.
+    It holds the texture names, the texture atlas (all textures
+    stacked into one uint8 array, which is memory mapped on load),
+    their alpha channels if they were ever needed, and the average
+    colors for each colorspace and averaging method (or interpolation,
+    for the 'resample' method) they have been loaded with so far.
+    '''
+
+    def __init__(self, cache_dir, textures_path, namefilter,
+                 texture_dimension, extra=()):
+
+        self.cache_dir = cache_dir
+        h = hashlib.sha1()
+        h.update(repr((CACHE_VERSION, namefilter.fingerprint(),
+                       texture_dimension, extra)).encode('utf-8'))
+        h.update(fingerprint_path(textures_path).encode('ascii'))
+        self.key = h.hexdigest()
+        self.path = os.path.join(cache_dir, 'palette-%s' % self.key)
+
+    def _colors_path(self, colorspace, variant):
+        return os.path.join(self.path, 'colors-%s-%s.npy' %
+                            (colorspace, variant))
+
+    def _save_array(self, path, array):
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix='.tmp-',
+                                   suffix='.npy')
+        with os.fdopen(fd, mode='wb') as f:
+            np.save(f, np.asarray(array))
+        os.replace(tmp, path)
+
+    def load(self, colorspace, variant):
+        '''Load (names, atlas, alpha, colors) from the cache.
+
+        alpha is None if the alpha channels haven't been cached, and
+        colors is None if this colorspace and variant (averaging or
+        interpolation method) haven't been cached yet. Returns None if
+        there is no complete entry.
+        '''
+
+        names_path = os.path.join(self.path, 'names.npy')
+        atlas_path = os.path.join(self.path, 'atlas.npy')
+        if not (os.path.isfile(names_path) and os.path.isfile(atlas_path)):
+            return None
+        names = [str(name) for name in np.load(names_path)]
+        atlas = np.load(atlas_path, mmap_mode='r')
+
+        alpha_path = os.path.join(self.path, 'alpha.npy')
+        alpha = None
+        if os.path.isfile(alpha_path):
+            alpha = np.load(alpha_path, mmap_mode='r')
+
+        return names, atlas, alpha, self.load_colors(colorspace, variant)
+
+    def load_colors(self, colorspace, variant):
+        '''Load the colors cached for a colorspace and variant, or
+        None if they haven't been cached.'''
+
+        colors_path = self._colors_path(colorspace, variant)
+        if not os.path.isfile(colors_path):
+            return None
+        return np.load(colors_path)
+
+    def save(self, names, atlas, alpha=None):
+        '''Create the cache entry from the texture names and atlas,
+        or add the alpha channels to an existing one.'''
+
+        if os.path.isdir(self.path):
+            alpha_path = os.path.join(self.path, 'alpha.npy')
+            if alpha is not None and not os.path.isfile(alpha_path):
+                self._save_array(alpha_path, alpha)
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        # Write everything to a temporary directory first, so that
+        # nobody can see a half written entry.
+        tmp = tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp-')
+        try:
+            np.save(os.path.join(tmp, 'names.npy'), np.array(names))
+            np.save(os.path.join(tmp, 'atlas.npy'), atlas)
+            if alpha is not None:
+                np.save(os.path.join(tmp, 'alpha.npy'), alpha)
+            os.rename(tmp, self.path)
+        except OSError:
+            # Someone else may have beaten us to it
+            shutil.rmtree(tmp, ignore_errors=True)
+            if not os.path.isdir(self.path):
+                raise
+
+    def save_colors(self, colorspace, variant, colors):
+        '''Add average colors for a colorspace and averaging or
+        interpolation method to an existing entry.'''
+
+        self._save_array(self._colors_path(colorspace, variant), colors)
+
+    def filter_results_path(self, namefilter):
+        '''Get a path for storing the results of a NameFilter. These
+        are shared by all entries made with the same filter settings,
+        since texture packs mostly have the same names.'''
+
+        key = hashlib.sha1(namefilter.fingerprint().encode('utf-8'))
+        return os.path.join(self.cache_dir,
+                            'names-%s.json' % key.hexdigest())
+
+    def lookup_table_path(self, key):
+        '''Get a path for storing a lookup table in this entry.'''
+
+        return os.path.join(self.path, 'lut-%s.npz' % key)
@@ -3,8 +3,14 @@ import sys
 import logging
 from logging import StreamHandler
 
-# Import from this package
-from pixelart.processing import PixelartProcessor
+# Import from this package. Anything needing numpy or PIL is
+# imported only once the arguments are parsed, so --help and
+# bad arguments are quick.
+from pixelart.options import MATCHERS, COLORSPACES, INTERPOLATIONS, \
+        PALETTE_METHODS, REGION_SIZES, DEFAULT_COLOR_CACHE_SIZE, P_NORMS, \
+        default_cache_dir, parse_p_norm
+from pixelart.metrics import RunMetrics
+from pixelart.report import write_block_report
 
 class CLIBlockReportCaller:
     '''Used so the CLI can get a block report
@@ -16,10 +22,7 @@ class CLIBlockReportCaller:
         self.path = path
 
     def done_processing(self, block_report):
-        with open(self.path, mode='w') as f:
-            for unique in block_report.keys():
-                numstr = ('%dx' % block_report[unique]).ljust(8)
-                f.write('%s%s\n' % (numstr, unique))
+        write_block_report(self.path, block_report)
 
 
 def valid_scale(string):
@@ -34,54 +37,96 @@ def valid_scale(string):
         raise argparse.ArgumentTypeError(msg)
     return w, h
 
-def cli_process():
+# Suffixes allowed on memory sizes
+SIZE_SUFFIXES = dict(K=2**10, M=2**20, G=2**30, T=2**40)
 
-    parser = argparse.ArgumentParser(description='Match pixels to textures',
-                                     epilog='To run the gui, use pixelart-gui.')
+def valid_memory_size(string):
+    number = string.upper().rstrip('B')
+    scale = 1
+    if number[-1:] in SIZE_SUFFIXES:
+        scale = SIZE_SUFFIXES[number[-1]]
+        number = number[:-1]
+    try:
+        size = float(number) * scale
+    except ValueError:
+        msg = "Invalid memory size %s" % string
+        raise argparse.ArgumentTypeError(msg)
+    if size < 0:
+        msg = "Memory size can't be negative!"
+        raise argparse.ArgumentTypeError(msg)
+    return int(size)
 
-    # Add positional arguments
-    parser.add_argument('input', metavar='INPUT', type=str,
-                        help='Path to image to convert into pixelart')
-    parser.add_argument('textures', metavar='TEXTURES', type=str,
-                        help='Path to directory containing textures')
-    parser.add_argument('output', metavar='OUTPUT', type=str,
-                        help='Path to output image')
+def valid_p_norm(string):
+    try:
+        return parse_p_norm(string)
+    except ValueError:
+        msg = "Invalid p-norm %s, must be a positive number, inf or " \
+              "one of %s" % (string, ', '.join(P_NORMS))
+        raise argparse.ArgumentTypeError(msg)
 
-    # Add optional arguments
-    parser.add_argument('--version', action='version',
-                        version='%(prog)s 0.1.0')
-    parser.add_argument('-p', '--p-norm', dest='p', type=float,
+def valid_region_size(string):
+    if string in REGION_SIZES:
+        return REGION_SIZES[string]
+    try:
+        size = int(string)
+    except ValueError:
+        msg = "Invalid region size %s" % string
+        raise argparse.ArgumentTypeError(msg)
+    if size < 1:
+        msg = "Region size must be 1 or greater!"
+        raise argparse.ArgumentTypeError(msg)
+    return size
+
+def add_engine_arguments(parser):
+    '''Add the options for how PixelartEngines match and load
+    textures, which the server shares.'''
+
+    parser.add_argument('-p', '--p-norm', dest='p', type=valid_p_norm,
                         default=2,
                         help='Minkowski p-norm used for matching\
                                 nearest neighbors in color space. p=2\
-                                specifies Euclidean distance, while p=1\
-                                specifies Manhattan distance. Any value\
-                                from 0 < p < infinity may be used.\
+                                (or euclidean) specifies Euclidean\
+                                distance, p=1 (or manhattan) Manhattan\
+                                distance and p=inf (or chebyshev) the\
+                                largest difference in any channel.\
+                                These three are much faster than any\
+                                other p > 0, which may also be used.\
                                 (default: %(default)s)')
     parser.add_argument('-c', '--color-space', dest='colorspace', type=str,
-                        choices=['RGB', 'HSV', 'YCbCr'], 
+                        choices=COLORSPACES,
                         default='RGB',
                         help='Color space in which nearest neighbors are\
                                 found. (default: %(default)s)')
     parser.add_argument('-i', '--interpolation', dest='interp', type=str,
-                        choices=['nearest', 'bilinear', 'bicubic', 
-                                 'lanczos'],
+                        choices=INTERPOLATIONS,
                         default='bicubic',
                         help='Interpolation method used to scale the\
                                 input image and to find the average\
                                 color of each texture. (default: \
                                 %(default)s)')
-    parser.add_argument('-r', '--report', dest='report', type=str,
-                        default=None,
-                        help='Path to output block report. This file will\
-                                contain numbers and types of blocks\
-                                (or textures) required to make the\
-                                pixelart. (default: %(default)s)')
-    parser.add_argument('-s', '--scaling', dest='scaling',
-                        type=valid_scale,
-                        help='Scaling to apply to input image.\
-                                Must be in format MxN, where both\
-                                M and N are positive integers.')
+    parser.add_argument('-a', '--average', dest='palette_method', type=str,
+                        choices=PALETTE_METHODS, default='resample',
+                        help='Method used to find the average color of\
+                                each texture. resample shrinks it with\
+                                the interpolation method, mean and\
+                                median use every pixel, and alpha\
+                                weights pixels by their opacity.\
+                                (default: %(default)s)')
+    parser.add_argument('-m', '--matcher', dest='matcher', type=str,
+                        choices=MATCHERS, default='auto',
+                        help='Method used to find nearest neighbors.\
+                                kdtree requires scipy. lut builds a\
+                                table of every 8-bit color, which is\
+                                slow once but very fast afterwards.\
+                                auto uses kdtree if scipy is\
+                                installed, otherwise brute.\
+                                (default: %(default)s)')
+    parser.add_argument('--color-cache', dest='color_cache_size', type=int,
+                        default=DEFAULT_COLOR_CACHE_SIZE,
+                        help='Number of colors whose nearest texture is\
+                                remembered between images, which speeds\
+                                up converting images which share colors.\
+                                0 turns this off. (default: %(default)s)')
     parser.add_argument('-t', '--texture-dimension',
                         dest='texture_dimension', type=valid_scale,
                         default=(16,16),
@@ -90,6 +135,16 @@ def cli_process():
                                 this dimension will be ignored.\
                                 Must be in format MxN, where both\
                                 M and N are positive integers.')
+    parser.add_argument('--cache-dir', dest='cache_dir', type=str,
+                        nargs='?', const=default_cache_dir(), default=None,
+                        help='Cache loaded textures (and lookup tables)\
+                                in this directory, so later runs with\
+                                the same textures start faster. Without\
+                                a value, %(const)s is used.')
+
+def add_log_level_arguments(parser):
+    '''Add -v and -q, which set args.log_level.'''
+
     parser.add_argument('-v', '--verbose', dest='log_level',
                         action='store_const',
                         const=logging.DEBUG, default=logging.INFO,
@@ -99,8 +154,123 @@ def cli_process():
                         const=logging.CRITICAL, default=logging.INFO,
                         help='Show only critical messages')
 
+def cli_process():
+
+    parser = argparse.ArgumentParser(description='Match pixels to textures',
+                                     epilog='To run the gui, use pixelart-gui.')
+
+    # Add positional arguments
+    parser.add_argument('input', metavar='INPUT', type=str,
+                        help='Path to image to convert into pixelart.\
+                                With --batch, a directory, glob pattern\
+                                or manifest file of images.')
+    parser.add_argument('textures', metavar='TEXTURES', type=str,
+                        help='Path to directory containing textures')
+    parser.add_argument('output', metavar='OUTPUT', type=str,
+                        help='Path to output image. With --batch, the\
+                                directory to put output images in.')
+
+    # Add optional arguments
+    parser.add_argument('--version', action='version',
+                        version='%(prog)s 0.1.0')
+    add_engine_arguments(parser)
+    parser.add_argument('-b', '--batch', dest='batch', action='store_true',
+                        help='Convert many images, loading the textures\
+                                only once. INPUT may be a directory, a\
+                                glob pattern (quote it!) or a manifest\
+                                (.txt, .csv, .tsv or .lst) with one\
+                                input per line, optionally followed by\
+                                a tab or comma and an output path.\
+                                Reports given with -r go in a\
+                                directory.')
+    parser.add_argument('--frames', dest='frames', action='store_true',
+                        help='Convert every frame of an animation. INPUT\
+                                may be an animated image (like a GIF) or\
+                                a directory of frames. If OUTPUT ends in\
+                                .gif, .png, .apng or .webp an animated\
+                                image is made, otherwise it is a\
+                                directory to put frames in. Reports given\
+                                with -r cover every frame.')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                        help='Number of worker processes to use with\
+                                --batch. (default: %(default)s)')
+    parser.add_argument('-w', '--workers', dest='workers', type=int,
+                        default=1,
+                        help='Number of threads used to decode textures,\
+                                and to match and render tiles of each\
+                                image. (default: %(default)s)')
+    parser.add_argument('-f', '--output-format', dest='output_format',
+                        type=str, default='png',
+                        help='Extension of output images made by\
+                                --batch, unless given in a manifest.\
+                                (default: %(default)s)')
+    parser.add_argument('-r', '--report', dest='report', type=str,
+                        default=None,
+                        help='Path to output block report. This file will\
+                                contain numbers and types of blocks\
+                                (or textures) required to make the\
+                                pixelart. (default: %(default)s)')
+    parser.add_argument('--region-report', dest='region_report', type=str,
+                        default=None,
+                        help='Path to output a block report for each\
+                                region of the output, so a large build\
+                                can be split up. Not available with\
+                                --batch or --frames.\
+                                (default: %(default)s)')
+    parser.add_argument('--region-size', dest='region_size',
+                        type=valid_region_size, default='chunk',
+                        help='Size in blocks of the regions used by\
+                                --region-report: chunk (16), map (128)\
+                                or any positive integer.\
+                                (default: %(default)s)')
+    parser.add_argument('--metrics', dest='metrics', type=str,
+                        default=None,
+                        help='Path to write a JSON report of the time\
+                                and memory used by each stage of the\
+                                run. (default: %(default)s)')
+    parser.add_argument('-s', '--scaling', dest='scaling',
+                        type=valid_scale,
+                        help='Scaling to apply to input image.\
+                                Must be in format MxN, where both\
+                                M and N are positive integers.')
+    parser.add_argument('--stream', dest='streaming', action='store_true',
+                        help='Write the output image a band at a time\
+                                instead of making it all in memory.\
+                                Only works for PNG and PPM output.')
+    parser.add_argument('-g', '--grid', dest='grid', action='store_true',
+                        help='Write which block goes where instead of\
+                                rendering textures. The format comes\
+                                from the extension of OUTPUT: .npy\
+                                (with a .names.txt file), .npz, .csv,\
+                                .nbt (structure file) or any image\
+                                format (one pixel per block).')
+    parser.add_argument('--max-memory', dest='max_memory',
+                        type=valid_memory_size, default=None,
+                        help='Work out of core on images which would\
+                                need more than this much memory, like\
+                                512M or 4G. Big arrays then go in\
+                                scratch files, and PNG and PPM output\
+                                is streamed. 0 always works out of\
+                                core. (default: no limit)')
+    parser.add_argument('--scratch-dir', dest='scratch_dir', type=str,
+                        default=None,
+                        help='Directory for scratch files made when\
+                                working out of core. (default: the\
+                                system temporary directory)')
+    add_log_level_arguments(parser)
+
     # Actually process arguments
     args = parser.parse_args(sys.argv[1:])
+    if args.region_report is not None and (args.batch or args.frames):
+        parser.error("--region-report can't be used with --batch "
+                     "or --frames")
+    # Each frame is rendered in memory, so frames can't be streamed
+    # or worked on out of core.
+    if args.frames and (args.streaming or args.grid or
+                        args.max_memory is not None or
+                        args.scratch_dir is not None):
+        parser.error("--stream, --grid, --max-memory and --scratch-dir "
+                     "can't be used with --frames")
 
     
     # Create logging handler which goes to stdout
@@ -108,18 +278,88 @@ def cli_process():
     handler.setFormatter(logging.Formatter(fmt='[%(levelname)s] %(message)s'))
     handler.setLevel(args.log_level)
 
+    # Only trace memory if someone will look at it, since it's slow.
+    metrics = RunMetrics(trace_memory=args.metrics is not None)
+
+    if args.batch:
+        return cli_batch(args, handler, metrics)
+    if args.frames:
+        return cli_frames(args, handler, metrics)
+
     # Instantiate the block report writer
     if args.report is not None:
         writer = CLIBlockReportCaller(args.report)
     else:
         writer = None
     # Instantiate PixelartProcessor
+    from pixelart.processing import PixelartProcessor
     processor = PixelartProcessor(args.textures, args.input, args.output,
             colorspace=args.colorspace, interp=args.interp,
             minkowski=args.p, image_scaling=args.scaling,
             texture_dimension=args.texture_dimension,
-            logging_handler=handler, ui_caller=writer)
+            matcher=args.matcher, cache_dir=args.cache_dir,
+            palette_method=args.palette_method,
+            streaming=args.streaming, grid_output=args.grid,
+            workers=args.workers, max_memory=args.max_memory,
+            scratch_dir=args.scratch_dir,
+            color_cache_size=args.color_cache_size,
+            region_report=args.region_report, region_size=args.region_size,
+            metrics=metrics, logging_handler=handler, ui_caller=writer)
     processor.process()
+    if args.metrics is not None:
+        metrics.save(args.metrics)
+
+def cli_batch(args, handler, metrics):
+
+    from pixelart.engine import PixelartEngine
+    from pixelart.batch import BatchProcessor, collect_jobs
+
+    logger = logging.getLogger('pixelart.batch')
+    logger.setLevel(1)
+    logger.addHandler(handler)
+
+    engine = PixelartEngine(args.textures, colorspace=args.colorspace,
+            interp=args.interp, minkowski=args.p,
+            texture_dimension=args.texture_dimension,
+            matcher=args.matcher, cache_dir=args.cache_dir,
+            workers=args.workers, palette_method=args.palette_method,
+            max_memory=args.max_memory, scratch_dir=args.scratch_dir,
+            color_cache_size=args.color_cache_size, logger=logger)
+    jobs = collect_jobs(args.input, args.output,
+                        '.' + args.output_format.lstrip('.'))
+    batch = BatchProcessor(engine, jobs, workers=args.jobs,
+            image_scaling=args.scaling, streaming=args.streaming,
+            grid_output=args.grid, report_dir=args.report, metrics=metrics,
+            logger=logger)
+    failures = batch.process()
+    if args.metrics is not None:
+        metrics.save(args.metrics)
+    if failures is None or len(failures) > 0:
+        sys.exit(1)
+
+def cli_frames(args, handler, metrics):
+
+    from pixelart.engine import PixelartEngine
+    from pixelart.animation import AnimationProcessor
+
+    logger = logging.getLogger('pixelart.animation')
+    logger.setLevel(1)
+    logger.addHandler(handler)
+
+    engine = PixelartEngine(args.textures, colorspace=args.colorspace,
+            interp=args.interp, minkowski=args.p,
+            texture_dimension=args.texture_dimension,
+            matcher=args.matcher, cache_dir=args.cache_dir,
+            workers=args.workers, palette_method=args.palette_method,
+            color_cache_size=args.color_cache_size, logger=logger)
+    animation = AnimationProcessor(engine, args.input, args.output,
+            image_scaling=args.scaling, report_path=args.report,
+            metrics=metrics, logger=logger)
+    done = animation.process()
+    if args.metrics is not None:
+        metrics.save(args.metrics)
+    if not done:
+        sys.exit(1)
 
 def main():
     cli_process()
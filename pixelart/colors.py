@@ -0,0 +1,95 @@
+'''Conversion of 8-bit sRGB colors to the perceptual colorspaces Lab
+(CIELAB, with a D65 white point) and OKLab, which PIL can't convert to.
+
+Both take the cube root of a linear transform of linear-light sRGB,
+then transform that again. Channels only take 256 values, so going
+from sRGB to linear light is a lookup in a table of 256 entries, and
+the rest is done in float32 a chunk of pixels at a time.
+'''
+
+import numpy as np
+
+from pixelart.options import PERCEPTUAL_COLORSPACES
+
+# Pixels converted at once, which bounds the temporary arrays
+CHUNK_PIXELS = 2**16
+
+# Linear-light sRGB to CIE XYZ, for a D65 white point
+SRGB_TO_XYZ = np.array([[0.4124564, 0.3575761, 0.1804375],
+                        [0.2126729, 0.7151522, 0.0721750],
+                        [0.0193339, 0.1191920, 0.9503041]])
+D65_WHITE = np.array([0.95047, 1.0, 1.08883])
+
+# Lab's cube root is replaced by a line below this
+LAB_EPSILON = (6 / 29)**3
+
+# Lab from f(X/Xn), f(Y/Yn) and f(Z/Zn)
+LAB_MATRIX = np.array([[0.0, 116.0, 0.0],
+                       [500.0, -500.0, 0.0],
+                       [0.0, 200.0, -200.0]])
+LAB_OFFSET = np.array([-16.0, 0.0, 0.0])
+
+# Linear-light sRGB to OKLab's cone responses, and OKLab from their
+# cube roots. See https://bottosson.github.io/posts/oklab/
+SRGB_TO_LMS = np.array([[0.4122214708, 0.5363325363, 0.0514459929],
+                        [0.2119034982, 0.6806995451, 0.1073969566],
+                        [0.0883024619, 0.2817188376, 0.6299787005]])
+OKLAB_MATRIX = np.array([[0.2104542553, 0.7936177850, -0.0040720468],
+                         [1.9779984951, -2.4285922050, 0.4505937099],
+                         [0.0259040371, 0.7827717662, -0.8086757660]])
+
+
+def srgb_to_linear():
+    '''Get a table of the linear-light value of every 8-bit sRGB
+    channel value.'''
+
+    c = np.arange(256) / 255
+    return np.where(c <= 0.04045, c / 12.92, ((c + 0.055) / 1.055)**2.4)
+
+
+SRGB_TO_LINEAR = srgb_to_linear().astype('float32')
+
+# For each colorspace: the matrix applied before the cube root, and
+# the matrix and offset applied after it. Matrices are transposed,
+# to multiply rows of pixels.
+_CONVERSIONS = {
+        'Lab': ((SRGB_TO_XYZ / D65_WHITE[:, np.newaxis]).T.astype('float32'),
+                LAB_MATRIX.T.astype('float32'),
+                LAB_OFFSET.astype('float32')),
+        'OKLab': (SRGB_TO_LMS.T.astype('float32'),
+                  OKLAB_MATRIX.T.astype('float32'),
+                  np.zeros(3, dtype='float32'))
+}
+
+
+def _lab_root(t):
+    # Lab's f(t), in place
+    small = t <= LAB_EPSILON
+    linear = t[small] * np.float32(1 / (3 * (6 / 29)**2)) + \
+            np.float32(4 / 29)
+    np.cbrt(t, out=t)
+    t[small] = linear
+    return t
+
+
+def convert_pixels(pixels, colorspace, chunk=CHUNK_PIXELS):
+    '''Convert an (..., 3) uint8 array of sRGB colors to colorspace
+    (one of PERCEPTUAL_COLORSPACES). Returns a float32 array of the
+    same shape, converted chunk pixels at a time.'''
+
+    if colorspace not in PERCEPTUAL_COLORSPACES:
+        raise ValueError("Can't convert to colorspace %r" % colorspace)
+    first, matrix, offset = _CONVERSIONS[colorspace]
+
+    pixels = np.asarray(pixels, dtype='uint8')
+    flat = pixels.reshape(-1, 3)
+    out = np.empty(flat.shape, dtype='float32')
+    for start in range(0, flat.shape[0], chunk):
+        mixed = SRGB_TO_LINEAR.take(flat[start:start+chunk]) @ first
+        if colorspace == 'Lab':
+            _lab_root(mixed)
+        else:
+            np.cbrt(mixed, out=mixed)
+        np.matmul(mixed, matrix, out=out[start:start+chunk])
+        out[start:start+chunk] += offset
+    return out.reshape(pixels.shape)
@@ -0,0 +1,804 @@
+from PIL import Image
+import numpy as np
+import os
+import logging
+import io
+import zipfile
+
+# Our own functions
+from pixelart.textures import NameFilter
+from pixelart.matching import brute_force_nearest, lookup_table, \
+        palette_key, pack_colors, unpack_colors, ColorCache, \
+        DEFAULT_MEMORY_BUDGET
+from pixelart.cache import PaletteCache
+from pixelart.palette import average_colors, convert_colors
+from pixelart.colors import convert_pixels
+from pixelart.render import output_shape, render_rows, render_bands, \
+        band_rows
+from pixelart.parallel import split_rows, run_tiles, ordered_map
+from pixelart.writers import open_band_writer
+from pixelart.grids import grid_writer, grid_dtype, palette_image
+from pixelart.scratch import scratch_array
+from pixelart.progress import ProgressReporter
+
+from pixelart.options import DEFAULT_COLOR_CACHE_SIZE, \
+        PERCEPTUAL_COLORSPACES
+
+# scipy's cKDTree, once we've looked for it. scipy is optional and
+# slow to import, so we don't look until we need it.
+_ckdtree = None
+
+def find_ckdtree():
+    '''Get scipy's cKDTree class, or None if scipy isn't installed.'''
+
+    global _ckdtree
+    if _ckdtree is None:
+        try:
+            from scipy.spatial import cKDTree
+            _ckdtree = cKDTree
+        except ImportError:
+            _ckdtree = False
+    return _ckdtree or None
+
+# Dictionary of interpolation strings to
+# PIL interpolation enumeration values
+interpval = dict(nearest=Image.NEAREST,
+                 bilinear=Image.BILINEAR,
+                 bicubic=Image.BICUBIC,
+                 lanczos=Image.LANCZOS)
+
+# Texture directories within jar file to
+# search...
+TEXTURE_DIR_GUESSES = [
+        'assets/minecraft/textures/blocks'
+]
+
+
+class PixelartEngine:
+    '''Matches images to a set of textures.
+
+    The textures are loaded once by load_textures(), after which any
+    number of images can be matched, rendered and reported on without
+    touching the filesystem. With workers > 1, matching and rendering
+    are split into tiles of rows which run on a pool of threads.
+    '''
+
+    def __init__(self, textures_path, colorspace='RGB', interp='bicubic',
+            minkowski=2, texture_dimension=(16,16), matcher='auto',
+            cache_dir=None, workers=1, palette_method='resample',
+            max_memory=None, scratch_dir=None,
+            color_cache_size=DEFAULT_COLOR_CACHE_SIZE, progress=None,
+            logger=None):
+
+        self.textures_path = textures_path
+        self.colorspace = colorspace
+        self.interp_name = interp
+        self.interp = interpval[interp]
+        self.minkowski = minkowski
+        self.texture_dimension = texture_dimension
+        self.matcher = matcher
+        self.cache_dir = cache_dir
+        self.palette_cache = None
+        self.workers = workers
+        self.palette_method = palette_method
+
+        # Images needing more than max_memory bytes are worked on out
+        # of core, with big arrays in scratch files in scratch_dir.
+        # plan_memory() decides, for each image.
+        self.max_memory = max_memory
+        self.scratch_dir = scratch_dir
+        self.out_of_core = False
+
+        # Nearest textures of colors seen in earlier images
+        self.color_cache = None
+        if color_cache_size > 0:
+            self.color_cache = ColorCache(color_cache_size)
+
+        # Set by load_textures()
+        self.names = None
+        self.palette = None
+        self.atlas = None
+        self.alpha = None
+        self.colors = None
+
+        # The RGB color of each texture resized to 1x1, for the
+        # 'resample' method, and the interpolation method used. Other
+        # colorspaces are converted from these without decoding again.
+        self.resampled = None
+        self.resampled_interp = None
+
+        # Matching and rendering report how many rows are done here,
+        # and stop early if its cancel token is set.
+        self.progress = progress
+        if self.progress is None:
+            self.progress = ProgressReporter()
+
+        self.logger = logger
+        if self.logger is None:
+            self.logger = logging.getLogger(__name__)
+
+    @property
+    def image_mode(self):
+        '''The PIL mode images are converted to before matching. PIL
+        can't convert to perceptual colorspaces, so for those it's RGB,
+        which we convert from ourselves.'''
+
+        if self.colorspace in PERCEPTUAL_COLORSPACES:
+            return 'RGB'
+        return self.colorspace
+
+    def decode_texture(self, source):
+        '''Decode one texture, returning (rgb, color, alpha) or None if
+        it can't be used. source is a path or a file object which can
+        be used by PIL.
+
+        This doesn't touch self, so textures can be decoded on a pool
+        of threads (PIL releases the GIL while decoding). color is only
+        found here for the 'resample' method, and alpha is only kept
+        for the 'alpha' method.
+        '''
+
+        try:
+            with Image.open(source) as texture:
+                # Check the size before decoding the whole thing
+                if self.texture_dimension is not None and \
+                        not texture.size == self.texture_dimension:
+                    return None
+                texture.load()
+            # And if we can't read it, just silently fail.
+        except (ValueError, OSError):
+            return None
+
+        # Resize to 1x1 using desired interpolation method, then
+        # get the only pixel in the image to find the average color.
+        # It's kept in RGB, and converted to our colorspace later.
+        # Other methods work on all the textures at once later.
+        color = alpha = None
+        if self.palette_method == 'resample':
+            color = np.array(texture.resize((1,1),
+                resample=self.interp).convert('RGB').getpixel((0,0)))
+        elif self.palette_method == 'alpha':
+            alpha = np.array(texture.convert('RGBA').getchannel('A'))
+
+        return np.array(texture.convert('RGB')), color, alpha
+
+    def add_texture(self, name, decoded):
+        '''Add a texture decoded by decode_texture() to self.textures.'''
+
+        if decoded is None:
+            return False
+        rgb, color, alpha = decoded
+
+        # All textures go into one atlas, so if we weren't told what to
+        # expect, the first texture decides.
+        if self.texture_dimension is None and self.textures:
+            size = next(iter(self.textures.values())).shape[1::-1]
+            if not rgb.shape[1::-1] == size:
+                self.logger.debug("Skipping %s, which isn't %dx%d" %
+                                  ((name,) + size))
+                return False
+
+        if color is not None:
+            self.colors[name] = color
+        if alpha is not None:
+            self.alphas[name] = alpha
+        self.textures[name] = rgb
+
+        return True
+
+    def load_texture(self, fi, name):
+        '''Load one texture into self.textures.
+        fi is a file object which can be used by PIL.
+        '''
+
+        return self.add_texture(name, self.decode_texture(fi))
+
+    def directory_sources(self, namefilter):
+        '''Yield (name, path) for the textures in our directory.'''
+
+        files = [os.path.splitext(fi)
+                 for fi in os.listdir(self.textures_path)]
+        for name, ext in namefilter.filter_list(files):
+            yield name, os.path.join(self.textures_path, name + ext)
+
+    def archive_sources(self, namefilter):
+        '''Yield (name, file object) for the textures in our zip (jar)
+        file, reading each one into memory in a single pass over the
+        archive.'''
+
+        with zipfile.ZipFile(self.textures_path, 'r') as fi:
+
+            for info in fi.infolist():
+
+                # If it's a directory, we don't really want it...
+                if info.is_dir():
+                    continue
+
+                # If it's not in our directory guesses, skip...
+                # We don't want to include items and entities.
+                ahead, atail = os.path.split(info.filename)
+                if ahead not in TEXTURE_DIR_GUESSES:
+                    continue
+
+                # Filter textures using the NameFilter, just
+                # like with a normal file...
+                aname, aext = os.path.splitext(atail)
+                if not namefilter.filter_file(aname, aext):
+                    continue
+
+                yield aname, io.BytesIO(fi.read(info))
+
+    def decode_textures(self, sources):
+        '''Decode textures from (name, source) pairs, on a pool of
+        threads if we have more than one worker, and add them in the
+        order of sources no matter which finishes first.'''
+
+        def decode(item):
+            name, source = item
+            return name, self.decode_texture(source)
+
+        for name, decoded in ordered_map(decode, sources, self.workers):
+            self.add_texture(name, decoded)
+
+    def load_textures(self):
+
+        self.colors = {}
+        self.textures = {}
+        self.alphas = {}
+        self.alpha = None
+        self.resampled = None
+
+        if self.textures_path is None:
+            self.logger.critical("Invalid texture path!")
+            return False
+
+        namefilter = NameFilter()
+
+        # Try the palette cache first, which saves decoding
+        # all the textures again.
+        self.palette_cache = None
+        if self.cache_dir is not None and \
+                os.path.exists(self.textures_path):
+            self.palette_cache = PaletteCache(self.cache_dir,
+                    self.textures_path, namefilter,
+                    self.texture_dimension, TEXTURE_DIR_GUESSES)
+            if self.load_cached_textures():
+                return True
+            self.load_filter_results(namefilter)
+
+        # If this is a directory, we assume
+        # all the textures are in the same directory
+        if os.path.isdir(self.textures_path):
+            self.decode_textures(self.directory_sources(namefilter))
+
+        # If it's a file, try to open it as an archive.
+        elif os.path.isfile(self.textures_path):
+            # Guess this is a zip (jar) file
+            head, tail = os.path.split(self.textures_path)
+            name, ext = os.path.splitext(tail)
+
+            # First check if it's a zip file
+            if zipfile.is_zipfile(self.textures_path):
+                # Now we're pretty sure this is a zip file.
+                # We can guess the location of the textures
+                self.decode_textures(self.archive_sources(namefilter))
+
+            # And our contingency plan is to fail!
+            else:
+                self.logger.critical("Unknown archive format %s!" % ext)
+                return False
+
+
+        if len(self.textures) == 0:
+            self.logger.critical("No loadable textures found in %s!" % self.textures_path)
+            return False
+
+        self.logger.info("Loaded %d textures!" % len(self.textures))
+
+        # Stack everything up for quick access by index
+        self.names = list(self.textures.keys())
+        self.atlas = np.stack(list(self.textures.values()))
+        if self.alphas:
+            self.alpha = np.stack([self.alphas[name] for name in self.names])
+        if self.colors:
+            self.resampled = np.array([self.colors[name]
+                                       for name in self.names], dtype='uint8')
+            self.resampled_interp = self.interp_name
+        self.textures = None
+        self.alphas = None
+        self.build_palette()
+
+        if self.palette_cache is not None:
+            self.save_cached_textures()
+            self.save_filter_results(namefilter)
+        return True
+
+    def build_palette(self):
+        '''Set self.palette to the average color of each texture in
+        self.atlas, in our colorspace.'''
+
+        if self.palette_method == 'resample':
+            # Already found one at a time while loading
+            colors = self.resampled
+        else:
+            colors = average_colors(self.atlas, self.alpha,
+                                    self.palette_method)
+        self.palette = convert_colors(colors, self.colorspace)
+        self.colors = dict(zip(self.names, self.palette))
+
+    def rebuild_palette(self, colorspace=None, palette_method=None,
+                        interp=None):
+        '''Change the colorspace, averaging method or interpolation
+        method of loaded textures.
+
+        This works on the atlas, or on the resampled colors of the
+        'resample' method, in one go. Only a new interpolation method
+        for 'resample' (or textures without colors to resample from,
+        like ones from the palette cache) needs every texture decoded
+        again.
+        '''
+
+        if colorspace is not None:
+            self.colorspace = colorspace
+        if palette_method is not None:
+            self.palette_method = palette_method
+        if interp is not None:
+            self.interp_name = interp
+            self.interp = interpval[interp]
+        if self.palette_method == 'resample' and (self.resampled is None or
+                self.resampled_interp != self.interp_name):
+            return self.load_textures()
+        if self.alpha is None and self.palette_method == 'alpha':
+            return self.load_textures()
+        self.build_palette()
+        return True
+
+    def palette_variant(self):
+        '''Get what, besides the colorspace, the palette depends on.'''
+
+        if self.palette_method == 'resample':
+            return self.interp_name
+        return self.palette_method
+
+    def load_cached_textures(self):
+        '''Load textures and colors from the palette cache.
+        Returns False if they haven't been cached.
+        '''
+
+        try:
+            cached = self.palette_cache.load(self.colorspace,
+                                             self.palette_variant())
+        except (OSError, ValueError) as e:
+            self.logger.warning("Couldn't read palette cache! (%s)" % e)
+            return False
+        if cached is None:
+            return False
+        names, atlas, alpha, colors = cached
+        self.names = names
+        self.atlas = atlas
+        self.alpha = alpha
+
+        # 'resample' colors are always cached in RGB too, and other
+        # colorspaces can be converted from those.
+        if self.palette_method == 'resample':
+            resampled = colors
+            if self.colorspace != 'RGB':
+                try:
+                    resampled = self.palette_cache.load_colors('RGB',
+                            self.palette_variant())
+                except (OSError, ValueError) as e:
+                    self.logger.warning("Couldn't read palette cache! "
+                                        "(%s)" % e)
+                    resampled = None
+            self.resampled = resampled
+            self.resampled_interp = self.interp_name
+
+        # We can make palettes for other methods from the atlas,
+        # but 'resample' needs everything decoded again if it
+        # hasn't been cached in RGB.
+        if colors is None:
+            if (self.palette_method == 'resample' and
+                    self.resampled is None) or (alpha is None and
+                    self.palette_method == 'alpha'):
+                return False
+            self.build_palette()
+            self.save_cached_textures()
+        else:
+            self.palette = colors
+            self.colors = dict(zip(names, colors))
+
+        self.logger.info("Loaded %d textures from cache!" %
+                         len(self.colors))
+        return True
+
+    def load_filter_results(self, namefilter):
+        '''Give namefilter the results cached by earlier runs.'''
+
+        path = self.palette_cache.filter_results_path(namefilter)
+        if not os.path.isfile(path):
+            return
+        try:
+            namefilter.load_results(path)
+        except (OSError, ValueError, KeyError) as e:
+            self.logger.warning("Couldn't read name filter cache! (%s)" % e)
+
+    def save_filter_results(self, namefilter):
+
+        try:
+            namefilter.save_results(
+                    self.palette_cache.filter_results_path(namefilter))
+        except OSError as e:
+            self.logger.warning("Couldn't write name filter cache! (%s)" % e)
+
+    def save_cached_textures(self):
+
+        try:
+            self.palette_cache.save(self.names, self.atlas, self.alpha)
+            self.palette_cache.save_colors(self.colorspace,
+                    self.palette_variant(), self.palette)
+            if self.palette_method == 'resample' and \
+                    self.resampled is not None and \
+                    self.resampled_interp == self.interp_name and \
+                    self.colorspace != 'RGB':
+                self.palette_cache.save_colors('RGB',
+                        self.palette_variant(), self.resampled)
+        except OSError as e:
+            self.logger.warning("Couldn't write palette cache! (%s)" % e)
+
+    def scale_image(self, image, scaling):
+        '''Scale a PIL image to scaling (width, height) and convert
+        it to our image_mode.'''
+
+        self.logger.debug("Scaling input to %dx%d..." % scaling)
+        return image.resize(scaling, resample=self.interp)\
+                .convert(self.image_mode)
+
+    def memory_estimate(self, height, width, render=True):
+        '''Estimate how many bytes matching an image of this size
+        needs in memory, and rendering it too if render is true.'''
+
+        pixels = height * width
+        # The image as an array, and the indices
+        total = pixels * (len(self.palette[0]) +
+                          grid_dtype(len(self.names)).itemsize)
+        if render:
+            # The output as an array, and as a PIL image
+            th, tw = self.atlas.shape[1:3]
+            total += 2 * pixels * th * tw * 3
+        return total
+
+    def plan_memory(self, height, width, render=True):
+        '''Decide whether to work on an image of this size out of core.
+        Returns True if we will.'''
+
+        estimate = self.memory_estimate(height, width, render)
+        self.out_of_core = self.max_memory is not None and \
+                estimate > self.max_memory
+        if self.out_of_core:
+            self.logger.info("Working out of core, since this image "
+                             "needs about %d MiB of memory." %
+                             (estimate // 2**20))
+        return self.out_of_core
+
+    def allocate(self, shape, dtype):
+        '''Make an uninitialized array, in a scratch file if we are
+        working out of core.'''
+
+        if self.out_of_core:
+            return scratch_array(shape, dtype, self.scratch_dir)
+        return np.empty(shape, dtype=dtype)
+
+    def match(self, image):
+        '''Find the index of the nearest texture for every pixel.
+
+        image is either a PIL image, which is converted to our
+        image_mode first, or an (h, w, 3) array already in it. Images
+        in RGB are converted to perceptual colorspaces as they are
+        matched.
+        Returns an (h, w) array of indices into self.names, of the
+        smallest unsigned type that fits them, or None if cancelled or
+        the image is empty.
+        '''
+
+        self.logger.info("Finding nearest neighbors...")
+
+        # PIL images are turned into arrays a tile at a time, so
+        # there's never a copy of the whole image.
+        if isinstance(image, Image.Image):
+            if image.mode != self.image_mode:
+                image = image.convert(self.image_mode)
+            pil_image = image
+            shape = (pil_image.height, pil_image.width)
+            def pixels(tile):
+                return np.asarray(pil_image.crop((0, tile.start,
+                        pil_image.width, tile.stop)))
+        else:
+            image = np.asarray(image)
+            shape = image.shape[0:2]
+            def pixels(tile):
+                return image[tile]
+        if shape[0] == 0 or shape[1] == 0:
+            self.logger.critical("Invalid image size %dx%d!" %
+                                 (shape[1], shape[0]))
+            return None
+        # The first row tells us what the pixels look like
+        sample = pixels(slice(0, 1))
+
+        # Find nearest neighbors here.
+        vals = self.palette
+
+        cKDTree = None
+        if self.matcher in ('auto', 'kdtree'):
+            cKDTree = find_ckdtree()
+
+        matcher = self.matcher
+        if matcher == 'auto':
+            matcher = 'kdtree' if cKDTree and self.minkowski >= 1 \
+                    else 'brute'
+        if matcher == 'kdtree' and not cKDTree:
+            self.logger.warning("scipy is not installed, so we can't "
+                                "use a cKDTree. Using brute force.")
+            matcher = 'brute'
+        if matcher == 'kdtree' and self.minkowski < 1:
+            self.logger.warning("A cKDTree can't match with p < 1. "
+                                "Using brute force.")
+            matcher = 'brute'
+        if matcher == 'lut' and (sample.dtype != np.uint8 or
+                                 sample.ndim != 3 or sample.shape[2] != 3):
+            self.logger.warning("Lookup tables need an 8-bit, 3 channel "
+                                "image. Using brute force.")
+            matcher = 'brute'
+        # Lookup tables are indexed by the pixels we are given, which
+        # are still RGB for perceptual colorspaces.
+        perceptual = self.colorspace in PERCEPTUAL_COLORSPACES
+        if matcher == 'lut' and perceptual:
+            self.logger.warning("Lookup tables can't be used with the "
+                                "%s colorspace. Using brute force." %
+                                self.colorspace)
+            matcher = 'brute'
+
+        # With a lookup table, every pixel is just a table lookup.
+        # The table is kept around, so building it is only slow for
+        # the first image matched against these textures.
+        if matcher == 'lut':
+            self.logger.debug("Getting color lookup table...")
+            path = None
+            if self.palette_cache is not None:
+                path = self.palette_cache.lookup_table_path(
+                        palette_key(vals, self.minkowski))
+            table = lookup_table(vals, p=self.minkowski, path=path)
+            match_tile = table.lookup
+
+        # Without the kdtree, brute force tiles of the image at once.
+        # This is vectorized over blocks of pixels, so it's still
+        # reasonably quick for palettes of a few hundred textures.
+        elif matcher == 'brute':
+            self.logger.debug("Brute forcing nearest neighbors - this "
+                              "step may take some time...")
+            budget = DEFAULT_MEMORY_BUDGET // max(1, self.workers)
+            def match_tile(pixels):
+                return brute_force_nearest(pixels, vals, p=self.minkowski,
+                                           memory_budget=budget)
+
+        # Make a cKDTree since we have scipy
+        else:
+            self.logger.debug("We have a cKDTree - this "
+                              "will be quick!")
+            kdtree = cKDTree(vals)
+            def match_tile(pixels):
+                _, neigh = kdtree.query(pixels.reshape(-1, pixels.shape[-1]),
+                                        k=1, p=self.minkowski)
+                return neigh.reshape(pixels.shape[:-1])
+
+        # Convert to perceptual colorspaces just before matching, so
+        # below that is only done once per distinct color, and the
+        # color cache can still be keyed by RGB.
+        if perceptual:
+            match_converted = match_tile
+            def match_tile(pixels):
+                return match_converted(convert_pixels(pixels,
+                                                      self.colorspace))
+
+        # Images often have far fewer colors than pixels, so unless
+        # we have a lookup table (which is per color already), only
+        # match each distinct color once.
+        if matcher != 'lut' and sample.dtype == np.uint8 and \
+                sample.ndim == 3 and sample.shape[2] == 3:
+            match_tile = self.distinct_matcher(match_tile)
+
+        rows = shape[0]
+
+        # We will put neighbors here when we find them
+        # These will be the indices to the keys and values...
+        neighbors = self.allocate(shape, grid_dtype(len(self.names)))
+
+        # Each tile is a band of rows, written straight into
+        # its own part of neighbors.
+        progress = self.progress
+        def match_rows(tile):
+            if progress.cancelled:
+                return
+            neighbors[tile] = match_tile(pixels(tile))
+            progress.advance(tile.stop - tile.start,
+                             (tile.start, neighbors[tile]))
+
+        progress.start('match', rows)
+        run_tiles(match_rows, split_rows(rows, self.workers), self.workers)
+        if progress.cancelled:
+            self.logger.warning("Cancelled while matching!")
+            return None
+        return neighbors
+
+    def warm_up(self):
+        '''Match a single pixel, which gets everything matching needs
+        ready: scipy is imported and lookup tables are built. Worth
+        doing before forking workers, so they share it.'''
+
+        return self.match(np.zeros((1, 1, 3), dtype='uint8'))
+
+    def distinct_matcher(self, match_colors):
+        '''Wrap a function matching an (..., 3) uint8 array so that it
+        only sees each distinct color once, and never sees colors which
+        are in our color cache.'''
+
+        cache = self.color_cache
+        if cache is not None:
+            cache.check(palette_key(self.palette, self.minkowski))
+
+        def match_tile(pixels):
+            keys = pack_colors(pixels).ravel()
+            colors, inverse = np.unique(keys, return_inverse=True)
+            # More colors than fit in the cache would just thrash it,
+            # and mostly distinct colors are unlikely to come again.
+            if cache is None or len(colors) > min(cache.size,
+                                                  keys.size // 2):
+                found = match_colors(unpack_colors(colors))
+            else:
+                found, hit = cache.get(colors)
+                missed = colors[~hit]
+                if len(missed) > 0:
+                    found[~hit] = match_colors(unpack_colors(missed))
+                    cache.put(missed, found[~hit])
+            return found[inverse].reshape(pixels.shape[:-1])
+
+        return match_tile
+
+    def render(self, neighbors):
+        '''Make the pixelart for the indices found by match().
+        Returns a PIL image, or None if it doesn't fit in memory or
+        we were cancelled.'''
+
+        self.logger.info("Creating output image...")
+
+        # Creating the final image may take a lot of RAM!
+        shape = output_shape(self.atlas, neighbors)
+        self.logger.debug("Allocating space for a %dx%d image..."\
+                % shape[1::-1])
+        try:
+            final = self.allocate(shape, 'uint8')
+        except MemoryError:
+            self.logger.critical("Ran out of memory while creating "
+                                  "final image!")
+            return None
+        self.logger.debug("Pasting textures into final image...")
+        th = self.atlas.shape[1]
+        progress = self.progress
+        def render_tile(tile):
+            if progress.cancelled:
+                return
+            render_rows(self.atlas, neighbors[tile],
+                        out=final[tile.start*th:tile.stop*th])
+            progress.advance(tile.stop - tile.start)
+        progress.start('render', neighbors.shape[0])
+        run_tiles(render_tile, split_rows(neighbors.shape[0], self.workers),
+                  self.workers)
+        if progress.cancelled:
+            self.logger.warning("Cancelled while rendering!")
+            return None
+        return Image.fromarray(final)
+
+    def render_to_file(self, neighbors, path):
+        '''Render the pixelart and save it to path a band at a time,
+        so it never has to be in memory all at once. Returns False if
+        the output format can't be streamed. If cancelled, this stops
+        between bands and removes the unfinished file.
+        '''
+
+        height, width, _ = output_shape(self.atlas, neighbors)
+        writer = open_band_writer(path, width, height)
+        if writer is None:
+            return False
+
+        self.logger.info("Streaming %dx%d output image..." %
+                         (width, height))
+        # Bands are rendered by the workers while we write them out.
+        # With one worker this is just render_bands().
+        step = band_rows(self.atlas, neighbors)
+        tiles = [neighbors[start:start+step]
+                 for start in range(0, neighbors.shape[0], step)]
+        progress = self.progress
+        progress.start('render', neighbors.shape[0])
+        with writer:
+            if self.workers <= 1:
+                bands = render_bands(self.atlas, neighbors)
+            else:
+                bands = ordered_map(lambda tile: render_rows(self.atlas,
+                                    tile), tiles, self.workers)
+            for band in bands:
+                if progress.cancelled:
+                    self.logger.warning("Cancelled while rendering!")
+                    writer.abort()
+                    break
+                writer.write(band)
+                progress.advance(band.shape[0] // self.atlas.shape[1])
+        return True
+
+    def save_grid(self, neighbors, path):
+        '''Save which texture goes where to path, without rendering any
+        textures. The format comes from the extension of path (see
+        grids.grid_writer()). Returns False if it isn't supported.
+        '''
+
+        writer = grid_writer(path)
+        if writer is None:
+            return False
+
+        self.logger.info("Saving %dx%d block grid..." %
+                         (neighbors.shape[1], neighbors.shape[0]))
+        writer(path, neighbors, self.names, self.preview_colors())
+        return True
+
+    def preview_colors(self):
+        '''Get the RGB color of each texture, as an (n, 3) uint8 array
+        for previews with one pixel per block.'''
+
+        # Previews show the plain average color of each texture
+        method = self.palette_method
+        if method == 'resample':
+            method = 'mean'
+        return average_colors(self.atlas, self.alpha, method)
+
+    def preview_image(self, neighbors):
+        '''Make a preview of the pixelart with one pixel per block.'''
+
+        return palette_image(neighbors, self.preview_colors())
+
+    def report(self, neighbors):
+        '''Count how many of each texture the indices need.
+        Returns a dict of texture name -> count.'''
+
+        counts = np.bincount(np.ravel(neighbors),
+                             minlength=len(self.names))
+        return self.counts_report(counts)
+
+    def region_reports(self, neighbors, size=16):
+        '''Count textures separately for each size by size region of
+        the indices, like Minecraft chunks (16) or maps (128).
+        Returns a dict of (region row, region column) -> report.
+        '''
+
+        n = len(self.names)
+        rows, cols = neighbors.shape
+        regions = -(-cols // size)
+        # Shift indices so every region in a band has its own bins
+        offsets = (np.arange(cols) // size) * n
+
+        reports = {}
+        for row, top in enumerate(range(0, rows, size)):
+            band = neighbors[top:top+size] + offsets
+            counts = np.bincount(band.ravel(), minlength=regions * n)
+            for col, region in enumerate(counts.reshape(regions, n)):
+                reports[row, col] = self.counts_report(region)
+        return reports
+
+    def counts_report(self, counts):
+        '''Turn an array of counts per texture index into a report,
+        leaving out unused textures. Names are in sorted order.'''
+
+        used = np.nonzero(counts)[0]
+        return dict(sorted((self.names[i], int(counts[i])) for i in used))
+
+    def texture_image(self, name):
+        '''Get the texture called name as a PIL image.'''
+
+        return Image.fromarray(np.asarray(self.atlas[self.names.index(name)]))
@@ -0,0 +1,244 @@
+'''Writers for block grids: which texture goes where, without
+rendering any textures.
+
+A grid is a 2D array of texture indices (as returned by
+PixelartEngine.match()) along with the list of texture names.
+'''
+
+from PIL import Image
+import numpy as np
+import csv
+import gzip
+import os
+import struct
+
+# Data version written into structure files, that of Minecraft 1.12.2
+STRUCTURE_DATA_VERSION = 1343
+
+# Blocks are written to structure files this many at a time,
+# which bounds the memory used by their encoded records.
+STRUCTURE_BLOCKS_PER_WRITE = 2**16
+
+# NBT tag types we use
+TAG_END = 0
+TAG_INT = 3
+TAG_STRING = 8
+TAG_LIST = 9
+TAG_COMPOUND = 10
+
+# One entry of a structure file's block list, encoded exactly as NBT:
+# a compound of pos (a list of three ints) and state (an int).
+_STRUCTURE_BLOCK = np.dtype([
+        ('pos_tag', 'u1'), ('pos_name_length', '>u2'), ('pos_name', 'S3'),
+        ('pos_type', 'u1'), ('pos_length', '>i4'),
+        ('x', '>i4'), ('y', '>i4'), ('z', '>i4'),
+        ('state_tag', 'u1'), ('state_name_length', '>u2'),
+        ('state_name', 'S5'), ('state', '>i4'),
+        ('end', 'u1')])
+
+
+def grid_dtype(count):
+    '''Get the smallest unsigned integer dtype for count indices.'''
+
+    for dtype in ('uint8', 'uint16', 'uint32'):
+        if count <= np.iinfo(dtype).max + 1:
+            return np.dtype(dtype)
+    return np.dtype('uint64')
+
+
+def compact_grid(grid, names):
+    return np.asarray(grid).astype(grid_dtype(len(names)))
+
+
+def names_path(path):
+    '''Get the path of the name table written next to an .npy grid.'''
+
+    return os.path.splitext(path)[0] + '.names.txt'
+
+
+def save_npy(path, grid, names, colors=None):
+    '''Save the grid as an .npy file, with the texture names in a
+    text file next to it, one per line in index order.'''
+
+    np.save(path, compact_grid(grid, names))
+    with open(names_path(path), mode='w') as f:
+        f.writelines('%s\n' % name for name in names)
+
+
+def save_npz(path, grid, names, colors=None):
+    '''Save the grid and texture names together as an .npz file.'''
+
+    np.savez_compressed(path, grid=compact_grid(grid, names),
+                        names=np.array(names))
+
+
+def save_csv(path, grid, names, colors=None):
+    '''Save the grid as CSV, with the texture name of every block.'''
+
+    names = np.array(names, dtype=object)
+    with open(path, mode='w', newline='') as f:
+        writer = csv.writer(f)
+        for row in grid:
+            writer.writerow(names[row])
+
+
+def _nbt_name(tag, name):
+    name = name.encode('utf-8')
+    return struct.pack('>BH', tag, len(name)) + name
+
+
+def _nbt_string(name, value):
+    value = value.encode('utf-8')
+    return _nbt_name(TAG_STRING, name) + struct.pack('>H', len(value)) + value
+
+
+def _nbt_int(name, value):
+    return _nbt_name(TAG_INT, name) + struct.pack('>i', value)
+
+
+def _nbt_int_list(name, values):
+    return _nbt_name(TAG_LIST, name) + \
+            struct.pack('>Bi%di' % len(values), TAG_INT, len(values),
+                        *values)
+
+
+def _nbt_list_header(name, tag, length):
+    return _nbt_name(TAG_LIST, name) + struct.pack('>Bi', tag, length)
+
+
+def save_structure(path, grid, names, colors=None,
+                   data_version=STRUCTURE_DATA_VERSION):
+    '''Save the grid as a gzipped NBT structure file, like those made
+    by structure blocks.
+
+    The grid lies flat, with rows along z and columns along x, as in
+    map art. Texture names are used as block names in the minecraft
+    namespace, so textures named after a side (like log_oak_top) may
+    need renaming before the structure can be loaded.
+    '''
+
+    grid = np.asarray(grid)
+    rows, cols = grid.shape
+    # Only used textures go in the palette
+    used, states = np.unique(grid, return_inverse=True)
+    states = states.reshape(grid.shape)
+
+    with gzip.open(path, mode='wb') as f:
+        f.write(_nbt_name(TAG_COMPOUND, ''))
+        f.write(_nbt_int('DataVersion', data_version))
+        f.write(_nbt_int_list('size', [cols, 1, rows]))
+
+        f.write(_nbt_list_header('palette', TAG_COMPOUND, len(used)))
+        for index in used:
+            f.write(_nbt_string('Name', 'minecraft:%s' % names[index]))
+            f.write(bytes([TAG_END]))
+
+        # Encode blocks a band of rows at a time, all at once
+        f.write(_nbt_list_header('blocks', TAG_COMPOUND, grid.size))
+        band = max(1, STRUCTURE_BLOCKS_PER_WRITE // cols)
+        for top in range(0, rows, band):
+            z, x = np.indices((min(band, rows - top), cols))
+            blocks = np.empty(x.size, dtype=_STRUCTURE_BLOCK)
+            blocks['pos_tag'] = TAG_LIST
+            blocks['pos_name_length'] = 3
+            blocks['pos_name'] = b'pos'
+            blocks['pos_type'] = TAG_INT
+            blocks['pos_length'] = 3
+            blocks['x'] = x.ravel()
+            blocks['y'] = 0
+            blocks['z'] = z.ravel() + top
+            blocks['state_tag'] = TAG_INT
+            blocks['state_name_length'] = 5
+            blocks['state_name'] = b'state'
+            blocks['state'] = states[top:top+band].ravel()
+            blocks['end'] = TAG_END
+            f.write(blocks.tobytes())
+
+        f.write(_nbt_list_header('entities', TAG_COMPOUND, 0))
+        f.write(bytes([TAG_END]))
+
+
+def palette_image(grid, colors):
+    '''Make a preview image with one pixel per block.
+
+    colors is an (n, 3) uint8 array of RGB colors for each texture.
+    The image is a palette (mode P) image if no more than 256
+    textures are used, and an RGB image otherwise.
+    '''
+
+    grid = np.asarray(grid)
+    used, pixels = np.unique(grid, return_inverse=True)
+    if len(used) > 256:
+        return Image.fromarray(np.asarray(colors, dtype='uint8')[grid])
+
+    # Giving an L image a palette makes it a P image
+    image = Image.fromarray(pixels.reshape(grid.shape).astype('uint8'))
+    image.putpalette(np.asarray(colors, dtype='uint8')[used].ravel()
+                     .tolist())
+    return image
+
+
+def save_preview(path, grid, names, colors):
+    palette_image(grid, colors).save(path)
+
+
+# Grid writers by extension. Any other extension PIL can write
+# gets a preview image. All are called with the path, the grid, the
+# texture names and the RGB color of each texture, used by previews.
+GRID_WRITERS = {'.npy': save_npy,
+                '.npz': save_npz,
+                '.csv': save_csv,
+                '.nbt': save_structure}
+
+
+def image_format(ext):
+    '''Get the PIL format which images with extension ext (like
+    '.png') are saved in, or None if PIL can't write them. Some
+    formats, like PSD, can only be read.'''
+
+    Image.init()
+    pil_format = Image.EXTENSION.get(ext.lower())
+    if pil_format not in Image.SAVE:
+        return None
+    return pil_format
+
+
+def grid_writer(path):
+    '''Get the function which saves a grid to path, from its
+    extension. Returns None if there isn't one.'''
+
+    ext = os.path.splitext(path)[1].lower()
+    if ext in GRID_WRITERS:
+        return GRID_WRITERS[ext]
+    if image_format(ext) is not None:
+        return save_preview
+    return None
+
+
+def check_output_path(path, logger, grid_output=False):
+    '''Check that we can save an image (or a block grid, if
+    grid_output) to path before doing any work, logging why not to
+    logger. Returns True if we can.'''
+
+    # Make sure the output path is not None or a directory
+    if path is None or os.path.isdir(path):
+        logger.critical("Invalid output path!")
+        return False
+    ext = os.path.splitext(path)[1]
+    if grid_output:
+        if grid_writer(path) is None:
+            logger.critical("Invalid block grid format! (%s)" % ext)
+            return False
+        return True
+    if image_format(ext) is None:
+        logger.critical("Invalid output format! (%s)" % ext)
+        return False
+    try:
+        Image.fromarray(np.array([[[0,0,0]]], dtype='uint8')).save(path)
+        return True
+    except ValueError as e:
+        logger.critical("Invalid output format! (%s)" % e)
+        return False
+    except OSError as e:
+        logger.critical("Invalid output path! (%s)" % e)
+        return False
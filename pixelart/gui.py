@@ -1,13 +1,18 @@
 from PIL import Image, ImageTk
+import numpy as np
 import logging
 import os, re, gc
 import sys
+import queue
 import tkinter as tk
 import tkinter.filedialog as filedialog
+import tkinter.ttk as ttk
 from threading import Thread
 
 # Import our own functions
-from pixelart.processing import PixelartProcessor
+from pixelart.pipeline import PixelartPipeline
+from pixelart.progress import ProgressReporter, CancelToken
+from pixelart.options import parse_p_norm, COLORSPACES
 
 
 PATH_FORMATS = [str, bytes, os.PathLike, int]
@@ -19,12 +24,32 @@ INTERP_DESCRIPTIONS = dict(
         lanczos='use a truncated sinc'
 )
 
+NORM_DESCRIPTIONS = {
+        1.0: 'Manhattan',
+        2.0: 'Euclidean (default)',
+        float('inf'): 'Chebyshev (largest difference)'
+}
+
 CSPACE_DESCRIPTIONS = dict(
         RGB='red, green, blue (default)',
         YCbCr='luma, chroma (color video)',
-        HSV='hue, saturation, brightness'
+        HSV='hue, saturation, brightness',
+        Lab='lightness, green-red, blue-yellow (perceptual)',
+        OKLab='like Lab, but more perceptually uniform'
+)
+
+STAGE_DESCRIPTIONS = dict(
+        match='Matching nearest neighbors',
+        render='Creating output image'
 )
 
+# How often (in milliseconds) the GUI looks for messages
+# from the processing thread
+POLL_INTERVAL = 50
+
+# Previews are shown at about this many pixels along the longest side
+PREVIEW_DISPLAY_SIZE = 256
+
 class BlockReportDialog(tk.Toplevel):
 
     def __init__(self, parent, textures, cols=3):
@@ -86,7 +111,10 @@ class OptionsDialog(tk.Toplevel):
         self.norm_var.set(str(options['p']))
         self.norm_var.trace('w', self.validate_norm)
         self.norm_label = tk.Label(body, text='Minkowski p-norm, p=')
-        self.norm_input = tk.Entry(body, width=10, textvariable=self.norm_var)
+        # The common norms can be picked, or any other p typed in.
+        self.norm_input = ttk.Combobox(body, width=10,
+                textvariable=self.norm_var,
+                values=['%g' % p for p in NORM_DESCRIPTIONS])
         self.norm_status = tk.Label(body)
         self.norm_label.grid(row=0, column=0, sticky='w')
         self.norm_input.grid(row=0, column=1, sticky='w')
@@ -97,7 +125,7 @@ class OptionsDialog(tk.Toplevel):
         self.cspace_var.set(options['colorspace'])
         self.cspace_var.trace('w', self.validate_option_menus)
         self.cspace_label = tk.Label(body, text='Color matching space:')
-        self.cspace_input = tk.OptionMenu(body, self.cspace_var, 'RGB', 'YCbCr', 'HSV')
+        self.cspace_input = tk.OptionMenu(body, self.cspace_var, *COLORSPACES)
         self.cspace_status = tk.Label(body)
         self.cspace_label.grid(row=1, column=0, sticky='w')
         self.cspace_input.grid(row=1, column=1, sticky='w')
@@ -139,20 +167,20 @@ class OptionsDialog(tk.Toplevel):
     def validate_norm(self, *args):
         val = self.norm_var.get()
         try:
-            val = float(val)
+            val = parse_p_norm(val)
             self.invalid_options.discard('p')
             self.norm_status['fg'] = 'black'
-            if val == 2.0:
-                self.norm_status['text'] = 'Euclidean (default)'
-            elif val == 1.0:
-                self.norm_status['text'] = 'Manhattan'
+            if val in NORM_DESCRIPTIONS:
+                self.norm_status['text'] = NORM_DESCRIPTIONS[val]
             else:
-                self.norm_status['text'] = 'p=%.1f'%val
+                # Only the common norms have fast paths
+                self.norm_status['text'] = 'p=%.1f (slower)'%val
 
-        except:
-            # We can't convert this into a float. That means it must be invalid!
+        except ValueError:
+            # We can't convert this into a norm. That means it must be invalid!
             self.norm_status['fg'] = 'red'
-            self.norm_status['text'] = 'Must be a number'
+            self.norm_status['text'] = 'Must be a positive number or ' \
+                    'inf'
             self.invalid_options.add('p')
         self.check_options()
 
@@ -177,7 +205,7 @@ class OptionsDialog(tk.Toplevel):
         # Set options in parent, then leave
         self.options['colorspace'] = self.cspace_var.get()
         self.options['interp'] = self.interp_var.get()
-        self.options['p'] = float(self.norm_var.get())
+        self.options['p'] = parse_p_norm(self.norm_var.get())
         self.parent.options = self.options
         self.cancel()
 
@@ -188,23 +216,20 @@ class OptionsDialog(tk.Toplevel):
 
 class StatusBarLoggingHandler(logging.Handler):
 
-    def __init__(self, statusbar):
+    def __init__(self, messages):
         '''Instantiate a new StatusBarLoggingHandler.
 
-        statusbar is a tkinter label to which we can
-        write text and change its color.
+        messages is a queue the Application takes messages
+        from to show in its status bar. Tk may only be used
+        from its own thread, so we can't show them ourselves.
         '''
 
         super().__init__()
-        self.statusbar = statusbar
+        self.messages = messages
 
     def emit(self, record):
 
-        self.statusbar['text'] = record.getMessage()
-        if record.levelno == logging.CRITICAL:
-            self.statusbar['fg'] = 'red'
-        else:
-            self.statusbar['fg'] = 'green'
+        self.messages.put(('status', record.getMessage(), record.levelno))
 
 
 class Application(tk.Frame):
@@ -226,12 +251,32 @@ class Application(tk.Frame):
 
         self.textures_ready = False
         self.input_ready = False
+        # Preview being built up while matching, and the image shown
+        self.live_preview = None
+        self.live_step = 1
+        self.preview_photo = None
         self.create_widgets()
-        self.handler = StatusBarLoggingHandler(self.statusbar)
-        self.handler.setLevel(5)
         self.update_status()
         self.thread = None
 
+        # The processing thread sends log messages, progress and
+        # its results here, for poll_messages() to show.
+        self.messages = queue.Queue()
+        self.handler = StatusBarLoggingHandler(self.messages)
+        self.handler.setLevel(logging.DEBUG)
+        self.cancel_token = CancelToken()
+        progress = ProgressReporter(
+                lambda progress: self.messages.put(('progress', progress)),
+                cancel_token=self.cancel_token)
+
+        # The pipeline remembers what it did last time, so running
+        # again with different options only redoes what they change.
+        logger = logging.getLogger('pixelart.gui')
+        logger.setLevel(1)
+        logger.addHandler(self.handler)
+        self.pipeline = PixelartPipeline(progress=progress, logger=logger)
+        self.poll_messages()
+
     def create_widgets(self):
 
         # First create a description label
@@ -240,6 +285,11 @@ class Application(tk.Frame):
         self.statusbar = tk.Label(self, relief='sunken', text='Not ready',
                 anchor='w', fg='red')
         self.statusbar.pack(side='bottom', fill='x', expand=1)
+
+        # Progress of the current stage
+        self.progressbar = ttk.Progressbar(self, mode='determinate',
+                maximum=1.0)
+        self.progressbar.pack(side='bottom', fill='x', expand=1)
         
         # Center buttons and part where things happen
         self.cont = tk.Frame(self)
@@ -296,6 +346,10 @@ class Application(tk.Frame):
         self.scaling_status = tk.Label(self.cont, text='')
         self.scaling_status.grid(row=2, column=1)
 
+        # Preview of the pixelart, one pixel per block
+        self.preview_label = tk.Label(self.cont)
+        self.preview_label.grid(row=3, column=0, columnspan=2)
+
         self.quit_button = tk.Button(self, text='Quit', fg='red',
                 command=self.exit_now)
         self.quit_button.pack(side='right', padx=5, pady=5)
@@ -305,6 +359,16 @@ class Application(tk.Frame):
                 state='disabled', command=self.process_thread)
         self.start_button.pack(side='right', padx=5, pady=5)
 
+        # Cancel button, only usable while processing
+        self.cancel_button = tk.Button(self, text='Cancel', fg='black',
+                state='disabled', command=self.cancel_processing)
+        self.cancel_button.pack(side='right', padx=5, pady=5)
+
+        # Preview button, for a quick look at a small version
+        self.preview_button = tk.Button(self, text='Preview', fg='black',
+                state='disabled', command=self.preview_thread)
+        self.preview_button.pack(side='right', padx=5, pady=5)
+
         # Options button
         self.options_button = tk.Button(self, text='Options', fg='black',
                 command=self.show_options)
@@ -340,24 +404,125 @@ class Application(tk.Frame):
         if out_path is None or os.path.isdir(out_path):
             return
 
+        # The thread stops early if the user cancels, between
+        # bands of rows. It must not touch any widgets itself.
+        self.start_processing(self.process, out_path)
+
+    def preview_thread(self):
+        self.start_processing(self.preview)
+
+    def start_processing(self, target, *args):
+
         # Prevent the user from touching the start button
         self.start_button['state'] = 'disabled'
+        self.preview_button['state'] = 'disabled'
+        self.cancel_button['state'] = 'active'
+        self.cancel_token.reset()
 
-        # Create processor
-        self.processor = PixelartProcessor(self.options['texture_path'], 
-                                      self.options['input_path'],
-                                      out_path,
-                                      image_scaling=self.options['input_scaling'],
-                                      logging_handler=self.handler,
-                                      ui_caller=self)
-        # We can't stop threads except by stopping the entire program.
-        # That's ok for us, the user can stop the program if needed.
-        self.thread = Thread(target=self.processor.process, daemon=True)
+        self.thread = Thread(target=target, args=args, daemon=True)
         self.thread.start()
 
+    def process(self, out_path):
+
+        report = self.pipeline.process(self.options, out_path)
+        if report is not None:
+            self.messages.put(('preview', self.pipeline.engine.preview_image(
+                    self.pipeline.neighbors)))
+        self.messages.put(('done', report))
+
+    def preview(self):
+
+        image = self.pipeline.preview(self.options)
+        if image is not None:
+            self.messages.put(('preview', image))
+        self.messages.put(('done', None))
+
+    def cancel_processing(self):
+        self.cancel_token.cancel()
+        self.cancel_button['state'] = 'disabled'
+
+    def poll_messages(self):
+        '''Show whatever the processing thread has sent us.'''
+
+        while True:
+            try:
+                message = self.messages.get_nowait()
+            except queue.Empty:
+                break
+            kind = message[0]
+            if kind == 'status':
+                _, text, level = message
+                self.statusbar['text'] = text
+                if level == logging.CRITICAL:
+                    self.statusbar['fg'] = 'red'
+                else:
+                    self.statusbar['fg'] = 'green'
+            elif kind == 'progress':
+                self.show_progress(message[1])
+            elif kind == 'preview':
+                self.show_preview(message[1])
+            elif kind == 'done':
+                self.done_processing(message[1])
+        self.after(POLL_INTERVAL, self.poll_messages)
+
+    def show_progress(self, progress):
+
+        self.progressbar['value'] = progress.fraction
+        text = '%s... %d%%' % (STAGE_DESCRIPTIONS.get(progress.stage,
+                progress.stage), progress.fraction * 100)
+        if progress.eta is not None and progress.fraction < 1:
+            text += ' (about %ds left)' % round(progress.eta)
+        self.statusbar['text'] = text
+        self.statusbar['fg'] = 'green'
+        if progress.stage == 'match':
+            self.update_live_preview(progress)
+
+    def update_live_preview(self, progress):
+        '''Color in the blocks of the bands matched since the last
+        progress report, in a preview no bigger than we'll show.'''
+
+        if progress.done == 0:
+            self.live_preview = None
+        if not progress.bands:
+            return
+        colors = self.pipeline.preview_colors
+        for start, band in progress.bands:
+            if self.live_preview is None:
+                rows, cols = progress.total, band.shape[1]
+                step = max(1, -(-max(rows, cols) // PREVIEW_DISPLAY_SIZE))
+                self.live_step = step
+                self.live_preview = np.zeros((-(-rows // step),
+                        -(-cols // step), 3), dtype='uint8')
+            # Only every step'th row and column is shown
+            step = self.live_step
+            first = -start % step
+            shown = band[first::step, ::step]
+            top = (start + first) // step
+            self.live_preview[top:top+len(shown)] = colors[shown]
+        self.show_preview(Image.fromarray(self.live_preview))
+
+    def show_preview(self, image):
+
+        # Small previews are blown up so the blocks can be seen
+        scale = max(1, PREVIEW_DISPLAY_SIZE // max(image.size))
+        if max(image.size) > PREVIEW_DISPLAY_SIZE:
+            image = image.copy()
+            image.thumbnail((PREVIEW_DISPLAY_SIZE, PREVIEW_DISPLAY_SIZE),
+                            Image.NEAREST)
+        image = image.convert('RGB').resize((image.width * scale,
+                image.height * scale), Image.NEAREST)
+        self.preview_photo = ImageTk.PhotoImage(image)
+        self.preview_label['image'] = self.preview_photo
+
     def done_processing(self, block_report):
-        self.show_block_report(block_report)
+        '''block_report is None if processing failed or
+        was cancelled.'''
+
         self.start_button['state'] = 'active'
+        self.preview_button['state'] = 'active'
+        self.cancel_button['state'] = 'disabled'
+        if block_report is not None:
+            self.show_block_report(block_report)
 
     def exit_now(self):
 
@@ -371,7 +536,7 @@ class Application(tk.Frame):
         for name in counts.keys():
             report_pics[name] = (
                     ImageTk.PhotoImage(
-                        self.processor.textures[name].copy()),
+                        self.pipeline.texture_image(name)),
                     counts[name]
             )
 
@@ -384,10 +549,12 @@ class Application(tk.Frame):
             self.statusbar['text'] = 'Not ready: load textures and image!'
             self.statusbar['fg'] = 'red'
             self.start_button['state'] = 'disabled'
+            self.preview_button['state'] = 'disabled'
         else:
             self.statusbar['text'] = 'Ready to pixelart!'
             self.statusbar['fg'] = 'green'
             self.start_button['state'] = 'normal'
+            self.preview_button['state'] = 'normal'
 
     def pick_texture_dir(self):
 
@@ -0,0 +1,437 @@
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# Rough upper bound (in bytes) on the temporary arrays allocated
+# while brute forcing nearest neighbors. Pixels are matched in
+# blocks small enough to stay under this.
+DEFAULT_MEMORY_BUDGET = 64 * 2**20
+
+# Bytes of scores worked on at once by the fast paths for p=1, p=2 and
+# p=inf. Blocks this small stay in the CPU cache, which is quicker than
+# making the most of the memory budget.
+FAST_BLOCK_BYTES = 2**20
+
+
+def minkowski_distances(pixels, palette, p=2):
+    '''Find the Minkowski distances between pixels and palette colors.
+
+    pixels is an (..., n, c) array and palette is an (..., m, c) array.
+    Returns an (..., n, m) array. For finite p, the p-th root is not
+    taken since it doesn't change which color is nearest.
+    '''
+
+    diff = pixels[..., :, np.newaxis, :] - palette[..., np.newaxis, :, :]
+    np.abs(diff, out=diff)
+    if np.isinf(p):
+        return diff.max(axis=-1)
+    if p == 2:
+        np.multiply(diff, diff, out=diff)
+    elif p != 1:
+        np.power(diff, p, out=diff)
+    return diff.sum(axis=-1)
+
+
+def is_common_norm(p):
+    '''Check if p is one of the norms with their own fast path.'''
+
+    return p == 1 or p == 2 or np.isinf(p)
+
+
+def score_dtype(pixels, palette, p):
+    '''Get the smallest dtype the fast path for p can score pixels
+    against palette colors in exactly, so that the nearest colors are
+    the same as in float64.
+
+    Integer pixels and palettes (like 8-bit colors) need no more than
+    int16 for p=1 and p=inf, or float32 (24 bits) for p=2. Anything
+    else is scored in float64.
+    '''
+
+    if not np.issubdtype(pixels.dtype, np.integer) or len(palette) == 0 \
+            or not np.array_equal(palette, np.rint(palette)):
+        return np.dtype('float64')
+    info = np.iinfo(pixels.dtype)
+    pixel_max = max(-int(info.min), int(info.max))
+    palette_max = float(np.abs(palette).max())
+    channels = palette.shape[1]
+    if p != 2 and channels * (pixel_max + palette_max) < 2**15:
+        return np.dtype('int16')
+    if channels * (pixel_max + palette_max)**2 < 2**24:
+        return np.dtype('float32')
+    return np.dtype('float64')
+
+
+def nearest_scores(pixels, palette, p=2):
+    '''Score every palette color for every pixel. The nearest color
+    has the lowest score, but scores are only distances for p=1
+    and p=inf.
+
+    pixels is an (n, c) array and palette is an (m, c) array, both of
+    the same dtype, which must be a float dtype for p=2 and p not 1
+    or inf. Returns an (n, m) array.
+    '''
+
+    if p == 2:
+        # |x - c|^2 = |x|^2 - 2 x.c + |c|^2, and |x|^2 is the same for
+        # every c, so this is one matrix product.
+        scores = pixels @ palette.T
+        scores *= -2
+        scores += np.einsum('ij,ij->i', palette, palette)
+        return scores
+    if p == 1 or np.isinf(p):
+        # Add up (or take the largest of) distances along each channel
+        # without making an (n, m, c) array of differences.
+        combine = np.maximum if np.isinf(p) else np.add
+        scores = np.abs(pixels[:, 0, np.newaxis] - palette[:, 0])
+        for k in range(1, palette.shape[1]):
+            combine(scores, np.abs(pixels[:, k, np.newaxis] - palette[:, k]),
+                    out=scores)
+        return scores
+    return minkowski_distances(pixels, palette, p)
+
+
+def brute_force_nearest(pixels, palette, p=2,
+                        memory_budget=DEFAULT_MEMORY_BUDGET):
+    '''Find the index of the nearest palette color for every pixel
+    without scipy.
+
+    pixels is an (..., c) array and palette is an (m, c) array.
+    Returns an intp array with the shape of pixels minus the last
+    axis. Pixels are matched a block at a time against the whole
+    palette, so memory use is bounded by memory_budget.
+
+    p=1, p=2 and p=inf have fast paths, which work in smaller dtypes
+    when that is exact (see score_dtype()), so the nearest colors are
+    the same as by the generic path.
+    '''
+
+    if not p > 0:
+        raise ValueError("Minkowski p-norm must be positive, not %r" % p)
+
+    palette = np.asarray(palette, dtype='float64')
+    pixels = np.asarray(pixels)
+    shape = pixels.shape[:-1]
+    pixels = pixels.reshape(-1, palette.shape[1])
+
+    dtype = np.dtype('float64')
+    if is_common_norm(p):
+        dtype = score_dtype(pixels, palette, p)
+        palette = palette.astype(dtype)
+        # Each pixel in a block needs a row of m scores, and
+        # one of m distances along a channel.
+        per_pixel = palette.shape[0] * 2 * dtype.itemsize
+        memory_budget = min(memory_budget, FAST_BLOCK_BYTES)
+    else:
+        # Each pixel in a block needs a row of m*c differences
+        # (8 bytes each), plus the m summed distances.
+        per_pixel = palette.shape[0] * (palette.shape[1] + 1) * 8
+    block = max(1, int(memory_budget // per_pixel))
+
+    neighbors = np.empty(pixels.shape[0], dtype='intp')
+    for start in range(0, pixels.shape[0], block):
+        chunk = pixels[start:start+block].astype(dtype)
+        scores = nearest_scores(chunk, palette, p)
+        neighbors[start:start+block] = np.argmin(scores, axis=1)
+
+    return neighbors.reshape(shape)
+
+
+def pack_colors(pixels):
+    '''Pack an (..., 3) uint8 array of colors into 24-bit integer keys.'''
+
+    keys = pixels[..., 0].astype('uint32') << 16
+    keys |= pixels[..., 1].astype('uint32') << 8
+    keys |= pixels[..., 2]
+    return keys
+
+
+def unpack_colors(keys):
+    '''Turn keys made by pack_colors() back into an (..., 3) array.'''
+
+    keys = np.asarray(keys, dtype='uint32')
+    return np.stack([keys >> 16, (keys >> 8) & 0xff, keys & 0xff],
+                    axis=-1).astype('uint8')
+
+
+class ColorCache:
+    '''Bounded cache of the nearest palette index for colors matched
+    before, dropping the least recently used colors first.
+
+    Keys are made by pack_colors(). The cache is only valid for one
+    palette and p-norm, whose palette_key() is given to check().
+    It can be shared by threads.
+    '''
+
+    def __init__(self, size):
+
+        self.size = size
+        self.key = None
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    # Locks can't be pickled, so processes which get a copy of the
+    # cache (like batch workers without fork) make their own.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def check(self, key):
+        '''Empty the cache unless it was filled for key.'''
+
+        with self.lock:
+            if key != self.key:
+                self.entries.clear()
+                self.key = key
+
+    def get(self, keys):
+        '''Look up an array of keys. Returns an array of indices and
+        a boolean array which is true where they were found.'''
+
+        found = []
+        indices = []
+        with self.lock:
+            entries = self.entries
+            for i, key in enumerate(keys.tolist()):
+                index = entries.get(key)
+                if index is not None:
+                    entries.move_to_end(key)
+                    found.append(i)
+                    indices.append(index)
+        result = np.zeros(len(keys), dtype='intp')
+        hit = np.zeros(len(keys), dtype=bool)
+        result[found] = indices
+        hit[found] = True
+        return result, hit
+
+    def put(self, keys, indices):
+        '''Add the indices found for an array of keys.'''
+
+        # Anything before the last size keys would be dropped anyway
+        keys = keys[-self.size:].tolist()
+        indices = indices[-self.size:].tolist()
+        with self.lock:
+            entries = self.entries
+            entries.update(zip(keys, indices))
+            while len(entries) > self.size:
+                entries.popitem(last=False)
+
+
+# Number of 8-bit values along each axis of one lookup table cell.
+# The color cube is split into (256/LUT_CELL)**3 cells, most of which
+# only have one possible nearest palette color.
+LUT_CELL = 8
+
+# Lookup tables built so far, keyed by palette_key(). Building a table
+# takes a while, so it's worth keeping the last few around.
+_lookup_tables = {}
+MAX_CACHED_TABLES = 4
+
+
+def palette_key(palette, p):
+    '''Get a string identifying a palette and p-norm.'''
+
+    h = hashlib.sha1(np.ascontiguousarray(palette, dtype='float64'))
+    h.update(repr(float(p)).encode('ascii'))
+    return h.hexdigest()
+
+
+def _axis_bounds(palette, p):
+    '''Find per-axis distance bounds between each cell and each color.
+
+    Returns two arrays of shape (cells, m, c), holding the smallest and
+    largest per-component distance (to the power p) from any integer
+    point in a cell to each palette color.
+    '''
+
+    lo = np.arange(0, 256, LUT_CELL, dtype='float64')
+    hi = lo + LUT_CELL - 1
+    lo = lo[:, np.newaxis, np.newaxis]
+    hi = hi[:, np.newaxis, np.newaxis]
+    dmin = np.maximum(np.maximum(lo - palette, palette - hi), 0)
+    dmax = np.maximum(np.abs(lo - palette), np.abs(hi - palette))
+    if not np.isinf(p):
+        dmin **= p
+        dmax **= p
+    return dmin, dmax
+
+
+class ColorLookupTable:
+    '''Table of the nearest palette color for every 8-bit color.
+
+    Building the table is a one-off cost per palette and p-norm, after
+    which matching an image is a single gather. The table is built
+    per cell of the color cube: colors which can't be nearest anywhere
+    in a cell are pruned, and cells with more than one candidate left
+    are refined exactly by brute force over their candidates. The
+    result is identical to brute_force_nearest().
+    '''
+
+    def __init__(self, palette, p=2, table=None):
+
+        if not p > 0:
+            raise ValueError("Minkowski p-norm must be positive, "
+                             "not %r" % p)
+
+        self.palette = np.asarray(palette, dtype='float64')
+        self.p = p
+        self.key = palette_key(self.palette, p)
+        if self.palette.shape[0] <= np.iinfo('uint16').max:
+            self.dtype = np.dtype('uint16')
+        else:
+            self.dtype = np.dtype('int32')
+
+        if table is None:
+            table = self.build()
+        self.table = table
+
+    def build(self):
+
+        palette = self.palette
+        p = self.p
+        cells = 256 // LUT_CELL
+        dmin, dmax = _axis_bounds(palette, p)
+
+        # Bounds along each axis, shape (cells, m)
+        rmin, gmin, bmin = np.moveaxis(dmin, 2, 0)
+        rmax, gmax, bmax = np.moveaxis(dmax, 2, 0)
+        if np.isinf(p):
+            combine = np.maximum
+        else:
+            combine = np.add
+
+        # For each cell, the palette colors which could be nearest to
+        # some point in it. A color is a candidate if its smallest
+        # distance to the cell is no more than the largest distance
+        # to the best color. The slack only admits extra candidates.
+        # We go one red slice of cells at a time to save memory.
+        candidates = []
+        uniform = np.empty((cells,) * 3, dtype=self.dtype)
+        for r in range(cells):
+            lower = combine(combine(rmin[r], gmin[:, np.newaxis]),
+                            bmin[np.newaxis, :])
+            upper = combine(combine(rmax[r], gmax[:, np.newaxis]),
+                            bmax[np.newaxis, :])
+            best = upper.min(axis=2, keepdims=True)
+            cand = lower <= best * (1 + 1e-9) + 1e-9
+            uniform[r] = np.argmax(cand, axis=2)
+            candidates.append(cand.reshape(-1, palette.shape[0]))
+        candidates = np.concatenate(candidates)
+
+        # Fill the whole table, one value per cell for now.
+        table = np.empty((cells, LUT_CELL) * 3, dtype=self.dtype)
+        table[...] = uniform[:, np.newaxis, :, np.newaxis, :, np.newaxis]
+
+        # Refine cells that have more than one candidate. Most have
+        # only a few, so sort by count to keep the padding small.
+        counts = candidates.sum(axis=1)
+        ambiguous = np.nonzero(counts > 1)[0]
+        ambiguous = ambiguous[np.argsort(counts[ambiguous], kind='stable')]
+        self._refine(table, ambiguous, candidates, counts)
+
+        return table.reshape(-1)
+
+    def _refine(self, table, ambiguous, candidates, counts,
+                memory_budget=DEFAULT_MEMORY_BUDGET):
+
+        cells = 256 // LUT_CELL
+        palette = self.palette
+        channels = palette.shape[1]
+
+        # Offsets of every point within a cell
+        offsets = np.indices((LUT_CELL,) * 3).reshape(3, -1).T
+        npoints = offsets.shape[0]
+
+        per_candidate = npoints * (channels + 1) * 8
+        start = 0
+        while start < len(ambiguous):
+            # Take as many cells as fit in memory, given the number of
+            # candidates of the last (largest) one. Cells are sorted by
+            # that, so shrinking the batch never makes it larger.
+            batch = len(ambiguous) - start
+            while True:
+                k = counts[ambiguous[start + batch - 1]]
+                if batch == 1 or batch * k * per_candidate <= memory_budget:
+                    break
+                batch = max(1, int(memory_budget // (k * per_candidate)))
+            idx = ambiguous[start:start+batch]
+            start += batch
+
+            # Candidate indices, in palette order so that ties go to
+            # the lowest index just like np.argmin over the whole
+            # palette. Cells with fewer than k candidates are padded
+            # with a color infinitely far away.
+            cand = np.argsort(~candidates[idx], axis=1, kind='stable')
+            cand = cand[:, :k]
+            colors = palette[cand]
+            colors[~np.take_along_axis(candidates[idx], cand, axis=1)] = \
+                    np.inf
+
+            r, g, b = np.unravel_index(idx, (cells,) * 3)
+            corner = np.stack([r, g, b], axis=1) * LUT_CELL
+            points = (corner[:, np.newaxis, :] + offsets).astype('float64')
+
+            dist = minkowski_distances(points, colors, self.p)
+            best = np.take_along_axis(cand, np.argmin(dist, axis=2),
+                                      axis=1)
+            table[r, :, g, :, b, :] = best.reshape((-1,) + (LUT_CELL,) * 3)
+
+    def lookup(self, pixels):
+        '''Find the nearest palette index for an (..., 3) uint8 array.'''
+
+        pixels = np.asarray(pixels)
+        if pixels.dtype != np.uint8 or pixels.shape[-1] != 3:
+            raise ValueError("Lookup tables only work with 8-bit, "
+                             "3 channel images")
+        return self.table[pack_colors(pixels)]
+
+    def save(self, path):
+        # Write to a temporary file first, so nobody loads a
+        # half written table.
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                   prefix='.tmp-', suffix='.npz')
+        with os.fdopen(fd, mode='wb') as f:
+            np.savez(f, key=np.array(self.key), table=self.table)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path, palette, p=2):
+        '''Load a table saved with save(). Returns None if it was built
+        for a different palette or p-norm.'''
+
+        with np.load(path) as f:
+            if str(f['key']) != palette_key(palette, p):
+                return None
+            return cls(palette, p, table=f['table'])
+
+
+def lookup_table(palette, p=2, path=None):
+    '''Get a ColorLookupTable for this palette, building it only if
+    one hasn't been built recently.
+
+    If path is given, the table is loaded from there if possible,
+    and saved there if it had to be built.
+    '''
+
+    key = palette_key(palette, p)
+    table = _lookup_tables.get(key)
+    if table is None and path is not None and os.path.isfile(path):
+        table = ColorLookupTable.load(path, palette, p)
+    if table is None:
+        table = ColorLookupTable(palette, p)
+        if path is not None:
+            table.save(path)
+    if key not in _lookup_tables:
+        if len(_lookup_tables) >= MAX_CACHED_TABLES:
+            _lookup_tables.pop(next(iter(_lookup_tables)))
+        _lookup_tables[key] = table
+    return table
@@ -0,0 +1,117 @@
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+class MetricsHook:
+    '''Receives metrics as they are recorded. Subclass this to send
+    them somewhere else, and add it with RunMetrics.add_hook().'''
+
+    def stage_done(self, stage):
+        '''Called with a StageRecord when a stage finishes.'''
+        pass
+
+    def counted(self, name, value):
+        '''Called when a counter is set or increased.
+        value is the counter's new total.'''
+        pass
+
+
+class StageRecord:
+    '''Time and memory used by one stage of a run.'''
+
+    def __init__(self, name):
+        self.name = name
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        # Peak traced memory in bytes above what was in use when
+        # the stage started, or None if memory wasn't traced.
+        self.peak_memory = None
+
+    def to_dict(self):
+        return dict(name=self.name, wall_time=self.wall_time,
+                    cpu_time=self.cpu_time, peak_memory=self.peak_memory)
+
+
+class RunMetrics:
+    '''Records wall time, CPU time and peak memory for each stage of a
+    run, along with counters like the number of pixels matched.
+
+    Memory is measured with tracemalloc, which sees NumPy arrays too.
+    Tracing slows Python down a bit, so it is optional.
+    '''
+
+    def __init__(self, trace_memory=False, hooks=None):
+
+        self.trace_memory = trace_memory
+        self.hooks = list(hooks) if hooks is not None else []
+        self.stages = []
+        self.counters = {}
+        self.started = time.perf_counter()
+        # Stages we're in, with their starting traced memory
+        self._active = []
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    @contextmanager
+    def stage(self, name):
+        '''Time everything done in a with block as the stage name.
+        Stages may be nested.'''
+
+        record = StageRecord(name)
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            current, peak = tracemalloc.get_traced_memory()
+            # Resetting the peak would lose it for any stage we're
+            # nested in, so hand it up first.
+            for outer, start in self._active:
+                outer.peak_memory = max(outer.peak_memory, peak - start)
+            # Before Python 3.9 the peak can't be reset, so stages get
+            # the highest peak since tracing started instead.
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            record.peak_memory = 0
+            self._active.append((record, current))
+
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield record
+        finally:
+            record.wall_time = time.perf_counter() - wall
+            record.cpu_time = time.process_time() - cpu
+            if self.trace_memory:
+                _, start = self._active.pop()
+                peak = tracemalloc.get_traced_memory()[1]
+                record.peak_memory = max(record.peak_memory, peak - start)
+                for outer, outer_start in self._active:
+                    outer.peak_memory = max(outer.peak_memory,
+                                            peak - outer_start)
+            self.stages.append(record)
+            for hook in self.hooks:
+                hook.stage_done(record)
+
+    def count(self, name, value=1):
+        '''Increase the counter name by value.'''
+
+        self.set_count(name, self.counters.get(name, 0) + value)
+
+    def set_count(self, name, value):
+        self.counters[name] = value
+        for hook in self.hooks:
+            hook.counted(name, value)
+
+    def to_dict(self):
+        return dict(stages=[stage.to_dict() for stage in self.stages],
+                    counters=dict(self.counters),
+                    wall_time=time.perf_counter() - self.started)
+
+    def save(self, path):
+        '''Write the metrics to path as JSON.'''
+
+        with open(path, mode='w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+            f.write('\n')
@@ -0,0 +1,61 @@
+'''Choices for options, and their defaults.
+
+This module must stay free of heavy imports (numpy, PIL, scipy,
+tkinter), since the command line uses it before parsing arguments.
+'''
+
+import os
+
+# Ways of finding nearest neighbors. 'auto' uses a cKDTree if scipy
+# is installed, and brute force otherwise.
+MATCHERS = ['auto', 'kdtree', 'brute', 'lut']
+
+# Color spaces nearest neighbors can be found in
+COLORSPACES = ['RGB', 'HSV', 'YCbCr', 'Lab', 'OKLab']
+
+# Perceptual color spaces, which we convert to ourselves (see
+# colors.py) since PIL can't
+PERCEPTUAL_COLORSPACES = ['Lab', 'OKLab']
+
+# Interpolation methods for scaling
+INTERPOLATIONS = ['nearest', 'bilinear', 'bicubic', 'lanczos']
+
+# Ways of finding the average color of each texture. 'resample'
+# shrinks each texture to one pixel with the interpolation method,
+# the others work on all the textures at once.
+PALETTE_METHODS = ['resample', 'mean', 'alpha', 'median']
+
+
+# Minkowski p-norms which may be given by name. These (and p=2, the
+# default) have their own fast paths for brute force matching.
+P_NORMS = dict(manhattan=1.0, euclidean=2.0, chebyshev=float('inf'))
+
+# Number of colors whose nearest texture is remembered between
+# images by default.
+DEFAULT_COLOR_CACHE_SIZE = 2**16
+
+# Named region sizes for split block reports: a Minecraft chunk
+# and the area covered by one map.
+REGION_SIZES = dict(chunk=16, map=128)
+
+
+def parse_p_norm(string):
+    '''Parse a p-norm given as a number, inf or a name in P_NORMS.
+    Raises ValueError if it isn't a positive number.'''
+
+    name = string.strip().lower()
+    if name in P_NORMS:
+        return P_NORMS[name]
+    p = float(name)
+    if not p > 0:
+        raise ValueError("p-norm must be positive, not %s" % string)
+    return p
+
+
+def default_cache_dir():
+    '''Get the per-user directory where palettes are cached.'''
+
+    base = os.environ.get('XDG_CACHE_HOME')
+    if not base:
+        base = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'pixelart')
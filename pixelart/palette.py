@@ -0,0 +1,53 @@
+from PIL import Image
+import numpy as np
+
+from pixelart.colors import convert_pixels
+from pixelart.options import PERCEPTUAL_COLORSPACES
+
+
+def average_colors(atlas, alpha=None, method='mean'):
+    '''Find the average color of every texture at once.
+
+    atlas is an (n, h, w, 3) uint8 array of textures, and alpha an
+    optional (n, h, w) array of their alpha channels. method is one of
+    'mean', 'alpha' (mean weighted by alpha, so transparent pixels
+    don't count) or 'median' (per channel). Returns an (n, 3) uint8
+    array of RGB colors.
+    '''
+
+    atlas = np.asarray(atlas)
+    n = atlas.shape[0]
+    pixels = atlas.reshape(n, -1, atlas.shape[-1])
+
+    if method == 'median':
+        colors = np.median(pixels, axis=1)
+    elif method == 'alpha' and alpha is not None:
+        weights = np.asarray(alpha).reshape(n, -1, 1).astype('float64')
+        total = weights.sum(axis=1)
+        colors = (pixels * weights).sum(axis=1) / np.maximum(total, 1)
+        # Fully transparent textures get the plain mean instead
+        clear = total[:, 0] == 0
+        colors[clear] = pixels[clear].mean(axis=1)
+    elif method in ('mean', 'alpha'):
+        colors = pixels.mean(axis=1, dtype='float64')
+    else:
+        raise ValueError("Unknown averaging method %r" % method)
+
+    return np.rint(colors).astype('uint8')
+
+
+def convert_colors(colors, colorspace):
+    '''Convert an (n, 3) uint8 array of RGB colors to colorspace.
+
+    All the colors go through PIL in one image, so the results are
+    exactly what PIL would give for each color on its own. Perceptual
+    colorspaces, which PIL doesn't have, give float32 colors instead.
+    '''
+
+    colors = np.asarray(colors, dtype='uint8')
+    if colorspace == 'RGB':
+        return colors
+    if colorspace in PERCEPTUAL_COLORSPACES:
+        return convert_pixels(colors, colorspace)
+    image = Image.fromarray(colors[np.newaxis])
+    return np.array(image.convert(colorspace))[0]
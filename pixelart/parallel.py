@@ -0,0 +1,56 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+
+# How many tiles to split work into per worker, so that
+# uneven tiles don't leave workers idle at the end.
+TILES_PER_WORKER = 4
+
+# Split work into at least this many tiles even with one
+# worker, so progress can be reported along the way.
+MIN_TILES = 16
+
+
+def split_rows(rows, workers=1):
+    '''Split range(rows) into a list of slices (tiles of whole rows)
+    for workers to work on.'''
+
+    count = max(1, min(rows, max(MIN_TILES, workers * TILES_PER_WORKER)))
+    step = -(-rows // count)
+    return [slice(start, min(start + step, rows))
+            for start in range(0, rows, step)]
+
+
+def run_tiles(function, tiles, workers=1):
+    '''Call function on every tile, on a pool of worker threads if
+    workers > 1. Exceptions are raised in the calling thread.
+
+    Our work is mostly done in NumPy, scipy and PIL, which release the
+    GIL, so threads run in parallel without copying any arrays.
+    '''
+
+    if workers <= 1 or len(tiles) <= 1:
+        for tile in tiles:
+            function(tile)
+        return
+    with ThreadPoolExecutor(workers) as pool:
+        for _ in pool.map(function, tiles):
+            pass
+
+
+def ordered_map(function, items, workers=1):
+    '''Like map(), but with function running on a pool of worker
+    threads. Results come back in order, and at most about 2*workers
+    are held at any time, which bounds memory use.'''
+
+    if workers <= 1:
+        for item in items:
+            yield function(item)
+        return
+    with ThreadPoolExecutor(workers) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(function, item))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
@@ -0,0 +1,285 @@
+from PIL import Image
+import numpy as np
+import os
+import logging
+from collections import OrderedDict
+
+from pixelart.engine import PixelartEngine, interpval
+from pixelart.textures import NameFilter
+from pixelart.metrics import RunMetrics
+from pixelart.grids import check_output_path
+
+# Rough upper bound (in bytes) on the stage results kept around.
+DEFAULT_PIPELINE_MEMORY = 512 * 2**20
+
+# Quick previews are matched at no more than this many blocks
+# along the longest side.
+PREVIEW_SIZE = 64
+
+# Options used when they aren't given, like PixelartProcessor's
+DEFAULT_OPTIONS = dict(input_scaling=None, p=2.0, interp='bicubic',
+                       colorspace='RGB', texture_dimension=(16,16),
+                       matcher='auto', palette_method='resample')
+
+
+def result_size(value):
+    '''Guess how many bytes a stage result takes up.'''
+
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, Image.Image):
+        return value.width * value.height * len(value.getbands())
+    if isinstance(value, PixelartEngine):
+        return sum(result_size(array) for array in
+                   (value.atlas, value.alpha, value.palette)
+                   if array is not None)
+    return 0
+
+
+class StageCache:
+    '''Results of pipeline stages, keyed by the stage and everything it
+    depends on. The least recently used results are dropped once they
+    take up more than max_memory bytes.'''
+
+    def __init__(self, max_memory=DEFAULT_PIPELINE_MEMORY):
+
+        self.max_memory = max_memory
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def get(self, stage, key):
+        '''Get a result, or None if it isn't cached.'''
+
+        entry = self.entries.get((stage, key))
+        if entry is None:
+            return None
+        self.entries.move_to_end((stage, key))
+        return entry[0]
+
+    def put(self, stage, key, value):
+
+        old = self.entries.pop((stage, key), None)
+        if old is not None:
+            self.size -= old[1]
+        size = result_size(value)
+        self.entries[stage, key] = (value, size)
+        self.size += size
+        # Never drop what we just added, even if it's too big alone
+        while self.size > self.max_memory and len(self.entries) > 1:
+            _, (_, dropped) = self.entries.popitem(last=False)
+            self.size -= dropped
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+
+class PixelartPipeline:
+    '''Converts images like PixelartProcessor, but remembers the result
+    of every stage, so running again with some options changed only
+    redoes the stages which depend on them:
+
+    - textures: texture path, name filter and texture dimension
+    - palette: textures, colorspace, averaging and interpolation method
+    - image: input path, scaling, interpolation method and colorspace
+    - neighbors: palette, image, p-norm and matcher
+    - render: neighbors
+
+    Saving the output is always done again.
+    '''
+
+    def __init__(self, max_memory=DEFAULT_PIPELINE_MEMORY, cache_dir=None,
+                 workers=1, metrics=None, progress=None, logger=None):
+
+        self.cache = StageCache(max_memory)
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self.progress = progress
+        self.namefilter = NameFilter()
+
+        self.metrics = metrics
+        if self.metrics is None:
+            self.metrics = RunMetrics()
+
+        self.logger = logger
+        if self.logger is None:
+            self.logger = logging.getLogger(__name__)
+
+        # From the last run
+        self.engine = None
+        self.preview_colors = None
+        self.neighbors = None
+        self.neighbors_key = None
+        self.output = None
+
+    def stage(self, stage, key, compute):
+        '''Get the result of stage for key, calling compute() to work
+        it out if it isn't cached. Results of None aren't cached.'''
+
+        value = self.cache.get(stage, key)
+        if value is not None:
+            self.logger.debug("Reusing %s from the last run" % stage)
+            return value
+        with self.metrics.stage(stage):
+            value = compute()
+        if value is not None:
+            self.cache.put(stage, key, value)
+        return value
+
+    def texture_key(self, options):
+        return (options['texture_path'], self.namefilter.fingerprint(),
+                options['texture_dimension'])
+
+    def palette_key(self, options):
+        # The palette only depends on the interpolation method
+        # when textures are resampled to find their colors.
+        interp = options['interp']
+        if options['palette_method'] != 'resample':
+            interp = None
+        return self.texture_key(options) + (options['colorspace'],
+                options['palette_method'], interp)
+
+    def load_engine(self, options):
+
+        engine = PixelartEngine(options['texture_path'],
+                colorspace=options['colorspace'], interp=options['interp'],
+                minkowski=options['p'],
+                texture_dimension=options['texture_dimension'],
+                matcher=options['matcher'], cache_dir=self.cache_dir,
+                workers=self.workers,
+                palette_method=options['palette_method'],
+                progress=self.progress, logger=self.logger)
+        if not engine.load_textures():
+            return None
+        # Loading made the palette for these options too
+        self.cache.put('palette', self.palette_key(options), engine.palette)
+        return engine
+
+    def build_palette(self, engine, options):
+
+        if not engine.rebuild_palette(options['colorspace'],
+                                      options['palette_method'],
+                                      options['interp']):
+            return None
+        return engine.palette
+
+    def load_image(self, options):
+
+        path = options['input_path']
+        self.logger.info("Loading input image %s" % path)
+        try:
+            image = Image.open(path)
+            if options['input_scaling'] is not None:
+                return self.engine.scale_image(image,
+                                               options['input_scaling'])
+            return image.convert(self.engine.image_mode)
+        except (OSError, ValueError) as e:
+            self.logger.critical("Couldn't load image! (%s)" % e)
+            return None
+
+    def match(self, options):
+        '''Run every stage up to matching the image, and return the
+        indices found, or None if something went wrong or we were
+        cancelled. Cancelled stages aren't remembered.'''
+
+        options = dict(DEFAULT_OPTIONS, **options)
+        engine = self.stage('textures', self.texture_key(options),
+                            lambda: self.load_engine(options))
+        if engine is None:
+            return None
+        self.engine = engine
+
+        palette_key = self.palette_key(options)
+        palette = self.stage('palette', palette_key,
+                             lambda: self.build_palette(engine, options))
+        if palette is None:
+            return None
+        engine.colorspace = options['colorspace']
+        engine.palette_method = options['palette_method']
+        engine.interp_name = options['interp']
+        engine.interp = interpval[options['interp']]
+        engine.palette = palette
+        engine.colors = dict(zip(engine.names, palette))
+        self.preview_colors = engine.preview_colors()
+
+        path = options['input_path']
+        if path is None or not os.path.isfile(path):
+            self.logger.critical("Invalid image path!")
+            return None
+        image_key = (path, os.stat(path).st_mtime_ns,
+                     options['input_scaling'], options['interp'],
+                     options['colorspace'])
+        image = self.stage('image', image_key,
+                           lambda: self.load_image(options))
+        if image is None:
+            return None
+
+        engine.minkowski = options['p']
+        engine.matcher = options['matcher']
+        neighbors_key = (palette_key, image_key, options['p'],
+                         options['matcher'])
+        self.neighbors = self.stage('neighbors', neighbors_key,
+                                    lambda: engine.match(image))
+        self.neighbors_key = neighbors_key
+        return self.neighbors
+
+    def is_output_path_valid(self, output_path):
+        '''Check that we can save to output_path, like
+        PixelartProcessor does, before doing any work.'''
+
+        return check_output_path(output_path, self.logger)
+
+    def process(self, options, output_path):
+        '''Convert an image with options (a dict like the GUI's, see
+        DEFAULT_OPTIONS for the ones which may be left out) and save it
+        to output_path. Returns a block report, or None if something
+        went wrong or we were cancelled.'''
+
+        if not self.is_output_path_valid(output_path):
+            return None
+        if self.match(options) is None:
+            return None
+
+        engine = self.engine
+        self.output = self.stage('render', self.neighbors_key,
+                                 lambda: engine.render(self.neighbors))
+        if self.output is None:
+            return None
+
+        with self.metrics.stage('save'):
+            try:
+                self.output.save(output_path)
+            except (OSError, ValueError) as e:
+                self.logger.critical("Couldn't save output! (%s)" % e)
+                return None
+
+        self.logger.info("Done!")
+        return engine.report(self.neighbors)
+
+    def preview(self, options, size=PREVIEW_SIZE):
+        '''Quickly match a copy of the input scaled down to at most
+        size blocks along its longest side, to check the options before
+        a full run. Returns a preview image with one pixel per block,
+        or None if something went wrong.'''
+
+        options = dict(DEFAULT_OPTIONS, **options)
+        scaling = options['input_scaling']
+        if scaling is None:
+            try:
+                with Image.open(options['input_path']) as image:
+                    scaling = image.size
+            except (OSError, ValueError, AttributeError) as e:
+                self.logger.critical("Couldn't load image! (%s)" % e)
+                return None
+        factor = min(1.0, size / max(scaling))
+        options['input_scaling'] = tuple(max(1, round(side * factor))
+                                         for side in scaling)
+
+        neighbors = self.match(options)
+        if neighbors is None:
+            return None
+        self.logger.info("Preview done!")
+        return self.engine.preview_image(neighbors)
+
+    def texture_image(self, name):
+        return self.engine.texture_image(name)
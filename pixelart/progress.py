@@ -0,0 +1,136 @@
+'''Progress reports and cancellation for long runs.
+
+Work like matching is split into bands of rows (see parallel.py),
+which report to a ProgressReporter as they finish and check its
+CancelToken before they start, so a run can be stopped between bands.
+'''
+
+import threading
+import time
+from collections import namedtuple
+
+# Progress callbacks are called at most this often (in seconds),
+# apart from at the start and end of every stage.
+DEFAULT_PROGRESS_INTERVAL = 0.1
+
+# What progress callbacks are called with. done and total are in
+# whatever the stage counts (rows, for matching and rendering),
+# fraction is done / total and eta is a guess of the seconds left,
+# or None before there is anything to guess from. bands is a list of
+# (first row, results) for bands finished since the last report,
+# for stages which have results to show (matching gives the indices
+# of the band's textures).
+Progress = namedtuple('Progress', ['stage', 'done', 'total', 'fraction',
+                                   'eta', 'bands'])
+
+
+class CancelToken:
+    '''Lets one thread ask work running in another to stop.'''
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    def reset(self):
+        self._event.clear()
+
+    # Events can't be pickled. A copy in another process starts out
+    # cancelled or not, but doesn't see later calls to cancel().
+    def __getstate__(self):
+        return dict(cancelled=self.cancelled)
+
+    def __setstate__(self, state):
+        self._event = threading.Event()
+        if state['cancelled']:
+            self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+
+class ProgressReporter:
+    '''Keeps track of how much of the current stage is done, and passes
+    it on to callback(progress) at most once every interval seconds.
+
+    advance() may be called from several worker threads at once. The
+    callback is called from whichever thread made the progress, so it
+    should be quick, and mustn't touch a GUI directly.
+    '''
+
+    def __init__(self, callback=None, interval=DEFAULT_PROGRESS_INTERVAL,
+                 cancel_token=None):
+
+        self.callback = callback
+        self.interval = interval
+        self.cancel_token = cancel_token
+        if self.cancel_token is None:
+            self.cancel_token = CancelToken()
+
+        self.lock = threading.Lock()
+        self.stage = None
+        self.done = 0
+        self.total = 0
+        self.bands = []
+        self.started = 0.0
+        self.reported = 0.0
+
+    @property
+    def cancelled(self):
+        return self.cancel_token.cancelled
+
+    # Locks can't be pickled, and callbacks (often into a GUI) can't
+    # be called from another process, so copies there report nothing.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        state['callback'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def start(self, stage, total):
+        '''Start a new stage, with total things to do.'''
+
+        with self.lock:
+            self.stage = stage
+            self.done = 0
+            self.total = total
+            self.bands = []
+            self.started = time.perf_counter()
+            self.report(self.started)
+
+    def advance(self, amount=1, band=None):
+        '''Record that amount more things are done. band is
+        (first row, results) of a finished band, if any.'''
+
+        with self.lock:
+            self.done += amount
+            if band is not None and self.callback is not None:
+                self.bands.append(band)
+            now = time.perf_counter()
+            if self.done >= self.total or \
+                    now - self.reported >= self.interval:
+                self.report(now)
+
+    def report(self, now):
+        # Called with the lock held, so reports come out in order
+
+        self.reported = now
+        if self.callback is None:
+            return
+        fraction = 1.0
+        if self.total > 0:
+            fraction = min(1.0, self.done / self.total)
+        eta = None
+        if self.done > 0:
+            eta = (now - self.started) * (self.total - self.done) / self.done
+            eta = max(0.0, eta)
+        bands = self.bands
+        self.bands = []
+        self.callback(Progress(self.stage, self.done, self.total, fraction,
+                               eta, bands))
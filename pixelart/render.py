@@ -0,0 +1,67 @@
+import numpy as np
+
+
+def output_shape(atlas, neighbors):
+    '''Get the (height, width, 3) shape of the pixelart made by
+    pasting textures from atlas at the indices in neighbors.'''
+
+    th, tw = atlas.shape[1:3]
+    rows, cols = neighbors.shape
+    return (rows * th, cols * tw, 3)
+
+
+def render_rows(atlas, neighbors, out=None):
+    '''Paste textures into an image, one row of blocks at a time.
+
+    atlas is an (n, th, tw, 3) uint8 array of textures and neighbors
+    is a (rows, cols) array of indices into it. The result has shape
+    (rows*th, cols*tw, 3). If out is given, the result is written
+    into it instead of a new array.
+    '''
+
+    th, tw = atlas.shape[1:3]
+    rows, cols = neighbors.shape
+    if out is None:
+        out = np.empty(output_shape(atlas, neighbors), dtype=atlas.dtype)
+
+    # Viewed like this, each row of blocks is just the gathered
+    # textures with the block and texture row axes swapped.
+    blocks = out.reshape(rows, th, cols, tw, 3)
+    for i in range(rows):
+        blocks[i] = atlas[neighbors[i]].transpose(1, 0, 2, 3)
+    return out
+
+
+# Rough size (in bytes) of one band of output when streaming.
+DEFAULT_BAND_BYTES = 64 * 2**20
+
+
+def band_rows(atlas, neighbors, band_bytes=DEFAULT_BAND_BYTES):
+    '''Get how many rows of blocks fit in a band of band_bytes.'''
+
+    height, width, channels = output_shape(atlas, neighbors)
+    row_bytes = height // max(1, neighbors.shape[0]) * width * channels
+    return max(1, int(band_bytes // max(1, row_bytes)))
+
+
+def render_bands(atlas, neighbors, band_bytes=DEFAULT_BAND_BYTES):
+    '''Render the image band by band. Yields arrays of shape
+    (rows*th, cols*tw, 3) from top to bottom, reusing one buffer.'''
+
+    th, tw = atlas.shape[1:3]
+    rows, cols = neighbors.shape
+    step = band_rows(atlas, neighbors, band_bytes)
+    buf = np.empty((step * th, cols * tw, 3), dtype=atlas.dtype)
+    for start in range(0, rows, step):
+        band = neighbors[start:start+step]
+        yield render_rows(atlas, band, out=buf[:band.shape[0] * th])
+
+
+def render_cells(atlas, neighbors, out, rows, cols):
+    '''Paste textures into an image made by render_rows(), only at the
+    blocks in rows and cols (arrays of block coordinates).'''
+
+    th, tw = atlas.shape[1:3]
+    blocks = out.reshape(neighbors.shape[0], th, neighbors.shape[1], tw, 3)
+    # Writing through this view puts each texture in its block
+    blocks.transpose(0, 2, 1, 3, 4)[rows, cols] = atlas[neighbors[rows, cols]]
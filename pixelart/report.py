@@ -0,0 +1,56 @@
+def format_block_report(block_report):
+    '''Format a block report (dict of name -> count) as text, one
+    texture per line.'''
+
+    lines = []
+    for unique in block_report.keys():
+        numstr = ('%dx' % block_report[unique]).ljust(8)
+        lines.append('%s%s\n' % (numstr, unique))
+    return ''.join(lines)
+
+
+def write_block_report(path, block_report):
+    with open(path, mode='w') as f:
+        f.write(format_block_report(block_report))
+
+
+def format_frame_reports(frame_reports):
+    '''Format block reports for the frames of an animation (list of
+    block reports) as text. The total over all frames comes first,
+    then a section per frame.'''
+
+    total = {}
+    for block_report in frame_reports:
+        for name, count in block_report.items():
+            total[name] = total.get(name, 0) + count
+    sections = ['All %d frames:\n%s' % (len(frame_reports),
+                format_block_report(dict(sorted(total.items()))))]
+    for number, block_report in enumerate(frame_reports):
+        sections.append('Frame %d:\n%s' % (number,
+                        format_block_report(block_report)))
+    return '\n'.join(sections)
+
+
+def write_frame_reports(path, frame_reports):
+    with open(path, mode='w') as f:
+        f.write(format_frame_reports(frame_reports))
+
+
+def format_region_reports(region_reports, size):
+    '''Format reports for regions of size by size blocks (dict of
+    (region row, region column) -> block report) as text, one section
+    per region.'''
+
+    sections = []
+    for (row, col), block_report in sorted(region_reports.items()):
+        top = row * size
+        left = col * size
+        sections.append('Region %d,%d (rows %d-%d, columns %d-%d):\n%s' %
+                        (row, col, top, top + size - 1, left,
+                         left + size - 1, format_block_report(block_report)))
+    return '\n'.join(sections)
+
+
+def write_region_reports(path, region_reports, size):
+    with open(path, mode='w') as f:
+        f.write(format_region_reports(region_reports, size))
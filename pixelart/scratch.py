@@ -0,0 +1,23 @@
+'''Arrays backed by temporary files, for images too big to work on
+in memory.'''
+
+import tempfile
+
+import numpy as np
+
+
+def scratch_array(shape, dtype, directory=None):
+    '''Make an uninitialized array backed by a temporary file in
+    directory (or the system's temporary directory).
+
+    The file is deleted as soon as it's made, so its space is freed
+    once the array is garbage collected. The operating system pages
+    the array in and out as needed, so it can be bigger than memory.
+    '''
+
+    dtype = np.dtype(dtype)
+    if int(np.prod(shape)) == 0:
+        # Empty files can't be mapped
+        return np.empty(shape, dtype=dtype)
+    with tempfile.TemporaryFile(dir=directory, prefix='pixelart-') as f:
+        return np.memmap(f, dtype=dtype, mode='w+', shape=shape)
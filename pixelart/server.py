@@ -0,0 +1,508 @@
+'''A local HTTP server which converts images, keeping the textures
+and palettes of one or more texture packs loaded between requests.
+
+POST /convert converts the image in the request body. Its query
+string may give the texture pack (pack=NAME, by default the first),
+the scaling (scale=WxH) and what to send back (format=EXT): an image
+format like png (the default) for the rendered pixelart, npz, csv or
+nbt for a block grid, or json for a block report.
+
+GET /packs lists the texture packs, and GET /metrics gives counters,
+time spent in each stage and how many requests are waiting.
+
+Conversions run on a pool of threads (NumPy, scipy and PIL release
+the GIL while they work, and threads share the loaded textures).
+Once too many are waiting, new ones are turned away with 503.
+'''
+
+from PIL import Image
+import numpy as np
+import argparse
+import asyncio
+import io
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+
+from pixelart.engine import PixelartEngine
+from pixelart.metrics import RunMetrics, MetricsHook
+from pixelart.grids import GRID_WRITERS, image_format
+from pixelart.render import render_rows
+from pixelart.writers import PNGWriter
+from pixelart.cli import valid_scale, valid_memory_size, \
+        add_engine_arguments, add_log_level_arguments
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+
+# Requests queued or running at once, beyond which we answer 503
+DEFAULT_MAX_QUEUE = 16
+
+# Largest request body (an encoded image) we'll read, in bytes
+DEFAULT_MAX_BODY = 32 * 2**20
+
+# Largest estimated memory use of one conversion, in bytes
+DEFAULT_MAX_MEMORY = 2**30
+
+# Block grid formats we can send back. .npy needs a second file
+# for the texture names, so it isn't one of them.
+GRID_FORMATS = [ext.lstrip('.') for ext in GRID_WRITERS if ext != '.npy']
+
+GRID_CONTENT_TYPES = dict(csv='text/csv')
+
+# PNG output is written by our own PNGWriter at this compression
+# level. PIL's filtering and compression would otherwise take longer
+# than matching small images, for files not much smaller.
+PNG_COMPRESS_LEVEL = 1
+
+STATUS_REASONS = {
+        100: 'Continue',
+        200: 'OK',
+        400: 'Bad Request',
+        404: 'Not Found',
+        405: 'Method Not Allowed',
+        411: 'Length Required',
+        413: 'Payload Too Large',
+        500: 'Internal Server Error',
+        503: 'Service Unavailable'
+}
+
+
+def has_body(headers):
+    '''Check whether a request has a body after its headers.'''
+
+    return headers.get('content-length', '0').strip() != '0' or \
+            'transfer-encoding' in headers
+
+
+class HTTPError(Exception):
+    '''Raised to answer a request with an error. If close is true, the
+    connection is closed afterwards (when the body wasn't read).'''
+
+    def __init__(self, status, message, close=False):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.close = close
+
+
+class StageTotals(MetricsHook):
+    '''Adds up the stages of every conversion, for /metrics. Stages
+    finish on the pool's threads, so updates take a lock.'''
+
+    def __init__(self):
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def stage_done(self, stage):
+        with self.lock:
+            count, wall_time = self.stages.get(stage.name, (0, 0.0))
+            self.stages[stage.name] = (count + 1,
+                                       wall_time + stage.wall_time)
+
+    def to_dict(self):
+        with self.lock:
+            stages = list(self.stages.items())
+        return {name: dict(count=count, wall_time=wall_time,
+                           mean_wall_time=wall_time / count)
+                for name, (count, wall_time) in stages}
+
+
+class PixelartServer:
+    '''Serves conversions with engines (dict of pack name ->
+    PixelartEngine) whose textures are already loaded.'''
+
+    def __init__(self, engines, workers=1, max_queue=DEFAULT_MAX_QUEUE,
+                 max_body=DEFAULT_MAX_BODY, max_memory=DEFAULT_MAX_MEMORY,
+                 logger=None):
+
+        self.engines = engines
+        self.default_pack = next(iter(engines))
+        self.workers = workers
+        self.max_queue = max_queue
+        self.max_body = max_body
+        self.max_memory = max_memory
+        self.pool = ThreadPoolExecutor(workers)
+
+        # Requests queued or running. Only touched on the event loop.
+        self.pending = 0
+        self.counters = dict(requests=0, converted=0, failed=0,
+                             rejected=0, pixels_matched=0, output_bytes=0)
+        self.totals = StageTotals()
+        self.started = time.perf_counter()
+
+        self.logger = logger
+        if self.logger is None:
+            self.logger = logging.getLogger(__name__)
+
+    def metrics(self):
+        return dict(uptime=time.perf_counter() - self.started,
+                    workers=self.workers,
+                    running=min(self.pending, self.workers),
+                    queued=max(0, self.pending - self.workers),
+                    max_queue=self.max_queue,
+                    counters=dict(self.counters),
+                    stages=self.totals.to_dict())
+
+    def packs(self):
+        return {name: dict(textures=len(engine.names),
+                           colorspace=engine.colorspace,
+                           default=name == self.default_pack)
+                for name, engine in self.engines.items()}
+
+    def decode_error(self, error):
+        '''Log why an image couldn't be decoded, and get the error to
+        answer with. PIL's messages can show our internals, so the
+        client only gets a fixed one.'''
+
+        self.logger.warning("Couldn't decode image! (%s)" % error)
+        return HTTPError(400, "Couldn't decode image!")
+
+    def convert(self, engine, data, scaling, output_format):
+        '''Convert an encoded image. Runs on the pool, and returns
+        (content type, body, pixels matched).'''
+
+        metrics = RunMetrics(hooks=[self.totals])
+        with metrics.stage('decode'):
+            try:
+                image = Image.open(io.BytesIO(data))
+            except (OSError, ValueError, Image.DecompressionBombError) as e:
+                raise self.decode_error(e)
+            width, height = image.size
+            if scaling is not None:
+                width, height = scaling
+            render = output_format not in GRID_FORMATS + ['json']
+            estimate = image.width * image.height * 4 + \
+                    engine.memory_estimate(height, width, render)
+            if estimate > self.max_memory:
+                raise HTTPError(413, "Converting this image would need "
+                                "about %d MiB of memory!" %
+                                (estimate // 2**20))
+            try:
+                if scaling is not None:
+                    image = engine.scale_image(image, scaling)
+                else:
+                    image = image.convert(engine.image_mode)
+            except (OSError, ValueError) as e:
+                raise self.decode_error(e)
+
+        with metrics.stage('match'):
+            neighbors = engine.match(image)
+        if neighbors is None:
+            raise HTTPError(400, "Invalid image size!")
+
+        if output_format == 'json':
+            with metrics.stage('report'):
+                body = json.dumps(engine.report(neighbors)).encode('utf-8')
+            return 'application/json', body, neighbors.size
+
+        if output_format in GRID_FORMATS:
+            # Grid writers want a path
+            with metrics.stage('save_grid'), \
+                    tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, 'grid.' + output_format)
+                engine.save_grid(neighbors, path)
+                with open(path, mode='rb') as f:
+                    body = f.read()
+            return GRID_CONTENT_TYPES.get(output_format,
+                    'application/octet-stream'), body, neighbors.size
+
+        with metrics.stage('render'):
+            output = render_rows(engine.atlas, neighbors)
+        with metrics.stage('encode'):
+            f = io.BytesIO()
+            pil_format = image_format('.' + output_format)
+            if pil_format == 'PNG':
+                height, width, _ = output.shape
+                with PNGWriter(f, width, height,
+                               compress_level=PNG_COMPRESS_LEVEL) as writer:
+                    writer.write(output)
+            else:
+                Image.fromarray(output).save(f, format=pil_format)
+        return Image.MIME.get(pil_format, 'application/octet-stream'), \
+                f.getvalue(), neighbors.size
+
+    def convert_options(self, query):
+        '''Get (engine, scaling, format) from a parsed query string.'''
+
+        def single(name, default=None):
+            values = query.get(name)
+            return values[-1] if values else default
+
+        pack = single('pack', self.default_pack)
+        if pack not in self.engines:
+            raise HTTPError(404, "Unknown texture pack %s!" % pack)
+
+        scaling = single('scale')
+        if scaling is not None:
+            try:
+                scaling = valid_scale(scaling)
+            except (ValueError, argparse.ArgumentTypeError):
+                raise HTTPError(400, "Invalid scaling %s!" % scaling)
+
+        output_format = single('format', 'png').lower().lstrip('.')
+        if output_format not in GRID_FORMATS + ['json'] and \
+                image_format('.' + output_format) is None:
+            raise HTTPError(400, "Unknown format %s!" % output_format)
+
+        return self.engines[pack], scaling, output_format
+
+    async def read_body(self, reader, writer, headers):
+
+        length = headers.get('content-length')
+        if length is None:
+            raise HTTPError(411, "Content-Length is needed!", close=True)
+        try:
+            length = int(length)
+        except ValueError:
+            raise HTTPError(400, "Invalid Content-Length!", close=True)
+        if length < 0 or length > self.max_body:
+            raise HTTPError(413, "Images may be at most %d bytes!" %
+                            self.max_body, close=True)
+
+        if headers.get('expect', '').lower() == '100-continue':
+            writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+            await writer.drain()
+        return await reader.readexactly(length)
+
+    async def handle_request(self, method, target, headers, reader, writer):
+        '''Returns (content type, body), or raises HTTPError.'''
+
+        url = urlsplit(target)
+        try:
+            if url.path in ('/metrics', '/packs'):
+                if method != 'GET':
+                    raise HTTPError(405, "Use GET!")
+                data = self.metrics() if url.path == '/metrics' \
+                        else self.packs()
+                return 'application/json', json.dumps(data).encode('utf-8')
+
+            if url.path != '/convert':
+                raise HTTPError(404, "Not found!")
+            if method != 'POST':
+                raise HTTPError(405, "Use POST!", close=True)
+
+            engine, scaling, output_format = \
+                    self.convert_options(parse_qs(url.query))
+        except HTTPError as e:
+            # An unread body would be taken for the next request
+            if has_body(headers):
+                e.close = True
+            raise
+
+        # Backpressure: turn the request away before reading the
+        # image, rather than queueing more than we can handle. The
+        # slot is taken before reading, so requests uploading at the
+        # same time can't all get past this.
+        if self.pending >= self.max_queue:
+            self.counters['rejected'] += 1
+            raise HTTPError(503, "Too many requests waiting!", close=True)
+
+        self.pending += 1
+        try:
+            data = await self.read_body(reader, writer, headers)
+            return await self.run_convert(engine, data, scaling,
+                                          output_format)
+        finally:
+            self.pending -= 1
+
+    async def run_convert(self, engine, data, scaling, output_format):
+        '''Convert on the pool. Returns (content type, body), or raises
+        HTTPError.'''
+
+        try:
+            content_type, body, pixels = \
+                    await asyncio.get_running_loop().run_in_executor(
+                            self.pool, self.convert, engine, data, scaling,
+                            output_format)
+        except HTTPError:
+            self.counters['failed'] += 1
+            raise
+        except Exception as e:
+            self.counters['failed'] += 1
+            self.logger.exception("Couldn't convert image!")
+            raise HTTPError(500, "Couldn't convert image! (%s: %s)" %
+                            (type(e).__name__, e))
+        self.counters['converted'] += 1
+        self.counters['pixels_matched'] += int(pixels)
+        self.counters['output_bytes'] += len(body)
+        return content_type, body
+
+    async def respond(self, writer, status, content_type, body, keep_alive):
+
+        head = ['HTTP/1.1 %d %s' % (status, STATUS_REASONS[status]),
+                'Content-Type: %s' % content_type,
+                'Content-Length: %d' % len(body),
+                'Connection: %s' % ('keep-alive' if keep_alive else 'close')]
+        if status == 503:
+            head.append('Retry-After: 1')
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') +
+                     body)
+        await writer.drain()
+
+    async def handle_connection(self, reader, writer):
+
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, target, version = \
+                            request_line.decode('latin-1').split()
+                except ValueError:
+                    await self.respond(writer, 400, 'text/plain',
+                                       b'Bad request line', False)
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                keep_alive = version == 'HTTP/1.1' and \
+                        headers.get('connection', '').lower() != 'close'
+
+                self.counters['requests'] += 1
+                start = time.perf_counter()
+                try:
+                    content_type, body = await self.handle_request(method,
+                            target, headers, reader, writer)
+                    status = 200
+                except HTTPError as e:
+                    status = e.status
+                    content_type = 'application/json'
+                    body = json.dumps(dict(error=e.message)).encode('utf-8')
+                    keep_alive = keep_alive and not e.close
+                self.logger.info("%s %s %d (%.1f ms)" % (method, target,
+                        status, (time.perf_counter() - start) * 1000))
+                await self.respond(writer, status, content_type, body,
+                                   keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            # Closed early, or a line too long for the reader
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        '''Serve until cancelled.'''
+
+        server = await asyncio.start_server(self.handle_connection,
+                                            host, port)
+        self.logger.info("Serving on http://%s:%d/" % (host, port))
+        async with server:
+            await server.serve_forever()
+
+
+def pack_name(path):
+    return os.path.splitext(os.path.basename(os.path.normpath(path)))[0]
+
+
+def load_engines(packs, engine_options, logger):
+    '''Load the textures of every pack (list of (name, path)) and warm
+    up matching. Returns a dict of name -> engine, or None.'''
+
+    engines = {}
+    for name, path in packs:
+        logger.info("Loading texture pack %s from %s" % (name, path))
+        engine = PixelartEngine(path, logger=logger, **engine_options)
+        if not engine.load_textures():
+            return None
+        # Matching once builds anything matching keeps, like lookup
+        # tables, before the first request.
+        engine.match(np.zeros((1, 1, 3), dtype='uint8'))
+        engines[name] = engine
+    return engines
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+            description='Serve pixelart conversions over HTTP',
+            epilog='POST an image to /convert?pack=NAME&scale=WxH&format=png\
+                    to convert it.')
+    parser.add_argument('packs', metavar='TEXTURES', type=str, nargs='+',
+                        help='Texture directories or zip/jar files to\
+                                keep loaded, optionally named like\
+                                NAME=PATH. Otherwise they are named after\
+                                the file. The first is used when a\
+                                request doesn\'t name one.')
+    parser.add_argument('--host', dest='host', type=str,
+                        default=DEFAULT_HOST,
+                        help='Address to listen on. (default: %(default)s)')
+    parser.add_argument('--port', dest='port', type=int,
+                        default=DEFAULT_PORT,
+                        help='Port to listen on. (default: %(default)s)')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                        help='Number of images converted at once.\
+                                (default: %(default)s)')
+    parser.add_argument('-w', '--workers', dest='workers', type=int,
+                        default=1,
+                        help='Number of threads used to match and render\
+                                tiles of each image. (default:\
+                                %(default)s)')
+    parser.add_argument('--max-queue', dest='max_queue', type=int,
+                        default=DEFAULT_MAX_QUEUE,
+                        help='Number of requests which may be queued or\
+                                running before more are turned away.\
+                                (default: %(default)s)')
+    parser.add_argument('--max-body', dest='max_body',
+                        type=valid_memory_size, default=DEFAULT_MAX_BODY,
+                        help='Largest image accepted, like 32M.\
+                                (default: %(default)s bytes)')
+    parser.add_argument('--max-memory', dest='max_memory',
+                        type=valid_memory_size, default=DEFAULT_MAX_MEMORY,
+                        help='Turn away images which would need more than\
+                                this much memory to convert, like 1G.\
+                                (default: %(default)s bytes)')
+    add_engine_arguments(parser)
+    add_log_level_arguments(parser)
+    args = parser.parse_args(sys.argv[1:])
+
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter(fmt='[%(levelname)s] %(message)s'))
+    handler.setLevel(args.log_level)
+    logger = logging.getLogger(__name__)
+    logger.setLevel(1)
+    logger.addHandler(handler)
+    # Engines log every image they match, which is too much for a
+    # server unless debugging.
+    engine_logger = logging.getLogger(__name__ + '.engine')
+    if args.log_level > logging.DEBUG:
+        engine_logger.setLevel(logging.WARNING)
+
+    packs = []
+    for pack in args.packs:
+        name, sep, path = pack.partition('=')
+        if not sep:
+            name, path = pack_name(pack), pack
+        packs.append((name, path))
+    if len(set(name for name, _ in packs)) < len(packs):
+        logger.critical("Texture packs need different names!")
+        sys.exit(1)
+
+    engines = load_engines(packs, dict(colorspace=args.colorspace,
+            interp=args.interp, minkowski=args.p,
+            texture_dimension=args.texture_dimension,
+            matcher=args.matcher, cache_dir=args.cache_dir,
+            workers=args.workers, palette_method=args.palette_method,
+            color_cache_size=args.color_cache_size), engine_logger)
+    if engines is None:
+        sys.exit(1)
+
+    server = PixelartServer(engines, workers=args.jobs,
+            max_queue=args.max_queue, max_body=args.max_body,
+            max_memory=args.max_memory, logger=logger)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
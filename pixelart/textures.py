@@ -1,4 +1,7 @@
+import json
+import os
 import re
+import tempfile
 
 DEFAULT_IGNORE_REGEX = ['sapling.*', 'wheat_stage.*', '.*grass.*', 
                         'water.*', 'redstone_dust.*', 'repeater.*',
@@ -31,7 +34,38 @@ DEFAULT_IGNORE_REGEX = ['sapling.*', 'wheat_stage.*', '.*grass.*',
                          'jukebox_top', '.*_command_block.*',
                          'bed_.*']
 
+# Backreferences and conditionals refer to groups by number, which
+# changes once patterns are joined together.
+_GROUP_REFERENCE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+
+
+def combine_regexes(regexes):
+    '''Join compiled regexes into one which matches wherever any of
+    them would, so a name needs only one matching pass. Returns None
+    if they can't be joined without changing what they match.'''
+
+    if not regexes:
+        return None
+    flags = regexes[0].flags
+    for regex in regexes:
+        if not isinstance(regex.pattern, str) or regex.flags != flags or \
+                _GROUP_REFERENCE.search(regex.pattern):
+            return None
+    try:
+        return re.compile('|'.join('(?:%s)' % regex.pattern
+                                   for regex in regexes), flags)
+    except re.error:
+        return None
+
+
 class NameFilter:
+    '''Decides which texture files to load, by their name and extension.
+
+    The regexes are joined into one pattern where possible, and the
+    result for each name is remembered, so the filter shouldn't be
+    changed after it is made. Results can be saved with save_results()
+    and loaded again by a filter with the same settings.
+    '''
 
     def __init__(self, regexes=DEFAULT_IGNORE_REGEX, 
                  formats=['.png'], 
@@ -48,6 +82,31 @@ class NameFilter:
         self.formats = formats
         self.format_blacklist = format_blacklist
 
+        self.combined = combine_regexes(self.regexes)
+        # Whether each name seen so far matched any regex
+        self.results = {}
+
+    def fingerprint(self):
+        '''Get a string which changes whenever the filter settings
+        change, so results of filtering can be cached.'''
+
+        return repr(([regex.pattern for regex in self.regexes],
+                     [fmt.lower() for fmt in self.formats],
+                     self.regex_blacklist, self.format_blacklist))
+
+    def matches(self, name):
+        '''Check if any of the regexes match name.'''
+
+        matched = self.results.get(name)
+        if matched is None:
+            if self.combined is not None:
+                matched = self.combined.match(name) is not None
+            else:
+                matched = any(regex.match(name) is not None
+                              for regex in self.regexes)
+            self.results[name] = matched
+        return matched
+
     def filter_file(self, name, ext):
         if ext.lower() in self.formats:
             if self.format_blacklist:
@@ -55,21 +114,49 @@ class NameFilter:
         else:
             if not self.format_blacklist:
                 return False
-        for regex in self.regexes:
-            if regex.match(name) is not None:
-                # If we are blacklisting, it matched once,
-                # so we return false. If we aren't black-
-                # listing, it matched once, so we pass it
-                return not self.regex_blacklist
-        # If we are blacklisting, it failed all the matches
-        # so we return true. If we're not, it failed all the
-        # matches so we return false...
-        return self.regex_blacklist
+        # If we are blacklisting and it matched, we return false.
+        # If we aren't blacklisting and it matched, we pass it.
+        # Failing all the matches does the opposite.
+        return self.matches(name) != self.regex_blacklist
 
     def filter_list(self, l):
         # We expect the format of l being a list of tuples
         # (name, ext) just like the filter_file function.
-        # We use *f to unpack the tuple.
-        return [f for f in l if self.filter_file(*f)]
+        # Checking the format first and looking up the cached
+        # results directly saves a couple of calls per name.
+        formats = set(self.formats)
+        results = self.results
+        passed = []
+        for f in l:
+            name, ext = f
+            if (ext.lower() in formats) == self.format_blacklist:
+                continue
+            matched = results.get(name)
+            if matched is None:
+                matched = self.matches(name)
+            if matched != self.regex_blacklist:
+                passed.append(f)
+        return passed
+
+    def save_results(self, path):
+        '''Save the cached result for each name seen so far to path.'''
+
+        # Write to a temporary file first, so nobody loads a
+        # half written file.
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                   prefix='.tmp-', suffix='.json')
+        with os.fdopen(fd, mode='w') as f:
+            json.dump(dict(fingerprint=self.fingerprint(),
+                           results=self.results), f)
+        os.replace(tmp, path)
 
+    def load_results(self, path):
+        '''Load results saved with save_results(). Returns False if
+        they were saved by a filter with different settings.'''
 
+        with open(path, mode='r') as f:
+            saved = json.load(f)
+        if saved.get('fingerprint') != self.fingerprint():
+            return False
+        self.results.update(saved['results'])
+        return True
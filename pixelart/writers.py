@@ -0,0 +1,218 @@
+import numpy as np
+import os
+import struct
+import zlib
+
+
+class BandWriter:
+    '''Writes an RGB image to a file a band of rows at a time,
+    so the whole image never has to be in memory. path may also be a
+    binary file object, which is left open.'''
+
+    def __init__(self, path, width, height):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.rows_written = 0
+        if hasattr(path, 'write'):
+            self.f = path
+            self.owned = False
+        else:
+            self.f = open(path, mode='wb')
+            self.owned = True
+        try:
+            self.write_header()
+        except:
+            self.release()
+            raise
+
+    def write_header(self):
+        pass
+
+    def write_band(self, band):
+        raise NotImplementedError
+
+    def write_footer(self):
+        pass
+
+    def write(self, band):
+        '''Write a (rows, width, 3) uint8 array below the rows
+        already written.'''
+
+        band = np.ascontiguousarray(band, dtype='uint8')
+        if band.shape[1:] != (self.width, 3):
+            raise ValueError("Band has shape %r, expected (rows, %d, 3)"
+                             % (band.shape, self.width))
+        if self.rows_written + band.shape[0] > self.height:
+            raise ValueError("Too many rows written to image!")
+        self.write_band(band)
+        self.rows_written += band.shape[0]
+
+    def release(self):
+        # Close the file, if we opened it
+        if self.f is not None and self.owned:
+            self.f.close()
+        self.f = None
+
+    def close(self):
+        if self.f is None:
+            return
+        try:
+            if self.rows_written != self.height:
+                raise ValueError("Only %d of %d rows were written!" %
+                                 (self.rows_written, self.height))
+            self.write_footer()
+        finally:
+            self.release()
+
+    def abort(self):
+        '''Stop writing and remove the unfinished file.'''
+
+        owned = self.owned
+        self.release()
+        if owned:
+            os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Don't complain about missing rows, something
+            # else already went wrong.
+            self.release()
+
+
+# Settings PIL saves PNGs with: its zlib memory level and strategy, and
+# the least compressed data it puts in each IDAT chunk. Using the same
+# ones makes our files byte for byte the same as PIL's.
+PNG_MEM_LEVEL = 9
+PNG_STRATEGY = zlib.Z_FILTERED
+PNG_CHUNK_BYTES = 65536
+
+# Rough size (in bytes) of the rows filtered at once. Filtering needs
+# several temporary copies of them, so keep it well below a band.
+FILTER_BLOCK_BYTES = 4 * 2**20
+
+
+def filter_rows(rows, prior, bpp=3):
+    '''PNG filter (n, row bytes) uint8 rows, picking a filter for each
+    row the way PIL does: whichever of none, up, sub and Paeth gives the
+    smallest sum of bytes taken as signed, ties going to the first.
+    prior is the row above the first one. Returns (n, 1 + row bytes)
+    rows, each starting with its filter type.'''
+
+    x = rows.astype('int16')
+    up = np.empty_like(x)
+    up[0] = prior
+    up[1:] = x[:-1]
+    left = np.zeros_like(x)
+    left[:, bpp:] = x[:, :-bpp]
+    upleft = np.zeros_like(x)
+    upleft[:, bpp:] = up[:, :-bpp]
+
+    # Paeth predictor: whichever neighbour is closest to left+up-upleft
+    p = left + up - upleft
+    pa = np.abs(p - left)
+    pb = np.abs(p - up)
+    pc = np.abs(p - upleft)
+    paeth = np.where((pa <= pb) & (pa <= pc), left,
+                     np.where(pb <= pc, up, upleft))
+
+    # In the order PIL tries them
+    kinds = np.array([0, 2, 1, 4], dtype='uint8')
+    filtered = np.stack([x, x - up, x - left, x - paeth]).astype('uint8')
+    signed = filtered.view('int8').astype('int16')
+    cost = np.abs(signed).sum(axis=2)
+    best = cost.argmin(axis=0)
+
+    out = np.empty((x.shape[0], 1 + x.shape[1]), dtype='uint8')
+    out[:, 0] = kinds[best]
+    out[:, 1:] = filtered[best, np.arange(x.shape[0])]
+    return out
+
+
+class PNGWriter(BandWriter):
+    '''Streams an 8-bit RGB PNG, byte for byte the same as PIL's at the
+    same compress_level.'''
+
+    def __init__(self, path, width, height, compress_level=6):
+        self.compressor = zlib.compressobj(compress_level, zlib.DEFLATED,
+                                           zlib.MAX_WBITS, PNG_MEM_LEVEL,
+                                           PNG_STRATEGY)
+        self.chunk_bytes = max(PNG_CHUNK_BYTES, width * 4)
+        self.pending = bytearray()
+        # Filters look at the row above, which for the first row is zeros
+        self.prior = np.zeros(width * 3, dtype='uint8')
+        super().__init__(path, width, height)
+
+    def write_chunk(self, kind, data):
+        self.f.write(struct.pack('>I', len(data)))
+        self.f.write(kind)
+        self.f.write(data)
+        self.f.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(kind))))
+
+    def write_header(self):
+        self.f.write(b'\x89PNG\r\n\x1a\n')
+        # 8 bits per channel, truecolor, no interlacing
+        self.write_chunk(b'IHDR', struct.pack('>IIBBBBB', self.width,
+                                              self.height, 8, 2, 0, 0, 0))
+
+    def write_idat(self, final=False):
+        # Write compressed data in whole chunks, keeping the rest
+        # until there's more, or we're done
+        start = 0
+        while len(self.pending) - start >= self.chunk_bytes:
+            end = start + self.chunk_bytes
+            self.write_chunk(b'IDAT', bytes(self.pending[start:end]))
+            start = end
+        if final and start < len(self.pending):
+            self.write_chunk(b'IDAT', bytes(self.pending[start:]))
+            start = len(self.pending)
+        del self.pending[:start]
+
+    def write_band(self, band):
+        rows = band.reshape(band.shape[0], -1)
+        step = max(1, FILTER_BLOCK_BYTES // rows.shape[1])
+        for y in range(0, rows.shape[0], step):
+            block = rows[y:y + step]
+            self.pending += self.compressor.compress(
+                filter_rows(block, self.prior))
+            # Copied, as the band's buffer may be reused
+            self.prior = block[-1].copy()
+        self.write_idat()
+
+    def write_footer(self):
+        self.pending += self.compressor.flush()
+        self.write_idat(final=True)
+        self.write_chunk(b'IEND', b'')
+
+
+class PPMWriter(BandWriter):
+    '''Streams a binary PPM, byte for byte the same as PIL's.'''
+
+    def write_header(self):
+        self.f.write(b'P6\n%d %d\n255\n' % (self.width, self.height))
+
+    def write_band(self, band):
+        self.f.write(band)
+
+
+# File extensions we can stream, and the writers for them.
+BAND_WRITERS = {
+        '.png': PNGWriter,
+        '.ppm': PPMWriter,
+        '.pnm': PPMWriter,
+}
+
+
+def open_band_writer(path, width, height):
+    '''Open a BandWriter for path, picking the format from its
+    extension. Returns None if we can't stream that format.'''
+
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in BAND_WRITERS:
+        return None
+    return BAND_WRITERS[ext](path, width, height)
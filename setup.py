@@ -28,17 +28,18 @@ setup(
             'Programming Language :: Python :: 3'
         ],
         keywords=['pixel', 'art', 'pixelart', 'minecraft'],
-        packages=find_packages(exclude=['contrib', 'docs', 'tests']),
+        packages=find_packages(exclude=['contrib', 'docs', 'tests', 'benchmarks']),
         install_requires=['numpy', 'Pillow'],
         extras_require={
             'faster nearest neighbors matching': ['scipy']
         },
-        python_requires='>=3.2',
+        python_requires='>=3.7',
         entry_points={
             'console_scripts': [
                 'pixelart=pixelart:main',
                 'pixelart-cli=pixelart:main_cli',
-                'pixelart-gui=pixelart:main_gui'
+                'pixelart-gui=pixelart:main_gui',
+                'pixelart-serve=pixelart:main_serve'
             ],
         }
 )